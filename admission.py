@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import datetime
+import logging
+import math
+import os
+import time
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger()
+
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", 1))
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 64))
+MAX_SCHEDULER_LAG = float(os.environ.get("MAX_SCHEDULER_LAG", 60))
+MAX_OUTBOX_DEPTH = int(os.environ.get("MAX_OUTBOX_DEPTH", 1000))
+MAX_LOOP_DELAY = float(os.environ.get("MAX_LOOP_DELAY", 0.5))
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 30))
+CREATE_QUOTA = int(os.environ.get("CREATE_QUOTA", 30))
+CREATE_QUOTA_WINDOW = float(os.environ.get("CREATE_QUOTA_WINDOW", 3600))
+
+
+class Health:
+    """Delivery health measured every `interval` seconds.
+
+    `scheduler_lag` is how long the earliest due job in `jobstore` or the latest submitted run waited,
+    `loop_delay` is how late the event loop woke up the monitor, `outbox_depth` are queued messages.
+    """
+
+    def __init__(self, schedule, jobstore, outbox_depth: Callable[[], int], interval: float = HEALTH_INTERVAL):
+        self.schedule = schedule
+        self.jobstore = jobstore
+        self.outbox_depth = outbox_depth
+        self.interval = interval
+        self.scheduler_lag = 0.0
+        self.submit_lag = 0.0
+        self.loop_delay = 0.0
+        self.task = None
+
+    def start(self):
+        self.schedule.add_listener(self.on_submitted, EVENT_JOB_SUBMITTED)
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.schedule.remove_listener(self.on_submitted)
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def on_submitted(self, event):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        late = (now - max(event.scheduled_run_times)).total_seconds()
+        self.submit_lag = max(self.submit_lag, late)
+
+    def overdue(self) -> float:
+        next_run_time = self.jobstore.get_next_run_time()
+        if next_run_time is None:
+            return 0.0
+        return max(0.0, (datetime.datetime.now(datetime.timezone.utc) - next_run_time).total_seconds())
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.loop_delay = max(0.0, loop.time() - started - self.interval)
+            try:
+                self.scheduler_lag = max(self.overdue(), self.submit_lag)
+            except Exception as e:
+                logger.error(f"Health check failed {e}")
+            self.submit_lag = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "scheduler_lag": round(self.scheduler_lag, 3),
+            "outbox_depth": self.outbox_depth(),
+            "loop_delay": round(self.loop_delay, 3),
+        }
+
+    def overloaded(self) -> Optional[str]:
+        """Reason to refuse new reminders, None when delivery keeps up."""
+        if self.scheduler_lag > MAX_SCHEDULER_LAG:
+            return f"scheduler is {self.scheduler_lag:.0f}s behind"
+        if self.outbox_depth() > MAX_OUTBOX_DEPTH:
+            return f"{self.outbox_depth()} messages waiting to be sent"
+        if self.loop_delay > MAX_LOOP_DELAY:
+            return f"event loop {self.loop_delay:.2f}s late"
+        return None
+
+
+class Admission:
+    """At most `limit` requests are handled at once, further ones are refused right away."""
+
+    def __init__(self, limit: int = MAX_IN_FLIGHT):
+        self.limit = limit
+        self.in_flight = 0
+
+    def full(self) -> bool:
+        return self.in_flight >= self.limit
+
+    def __enter__(self):
+        self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.in_flight -= 1
+
+
+class Quota:
+    """Every user creates at most `limit` reminders per `window` seconds.
+
+    `check` before the work, `take` once the reminder is stored, so refused or failed requests cost nothing.
+    """
+
+    def __init__(self, limit: int = CREATE_QUOTA, window: float = CREATE_QUOTA_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.created: Dict[Tuple[str, str], Deque[float]] = {}
+        self.swept = time.monotonic()
+
+    def check(self, realm: str, email: str) -> float:
+        """0 or seconds until the user may create again, takes nothing."""
+        created = self.created.get((realm, email))
+        if created is None:
+            return 0.0
+        now = time.monotonic()
+        self.expire((realm, email), created, now)
+        if len(created) >= self.limit:
+            return created[0] + self.window - now
+        return 0.0
+
+    def take(self, realm: str, email: str):
+        """Counts one created reminder."""
+        now = time.monotonic()
+        self.created.setdefault((realm, email), collections.deque()).append(now)
+        if now - self.swept > self.window:
+            self.sweep(now)
+
+    def expire(self, key: Tuple[str, str], created: Deque[float], now: float):
+        while created and created[0] <= now - self.window:
+            created.popleft()
+        if not created:
+            del self.created[key]
+
+    def sweep(self, now: float):
+        """Drops the users who created nothing within the window."""
+        for key, created in list(self.created.items()):
+            self.expire(key, created, now)
+        self.swept = now
+
+
+def busy_response(reason: str, retry_after: float = RETRY_AFTER, status_code: int = 503) -> JSONResponse:
+    return JSONResponse(
+        {"success": False, "busy": True, "result": reason},
+        status_code=status_code,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
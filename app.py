@@ -1,47 +1,55 @@
+import asyncio
+import contextvars
 import datetime
+import functools
 import json
 import logging
 import os
-import re
-from math import modf
+import time as clock
 from typing import Optional
 
 import databases
 import pytz
 import urllib3
-import zulip
 from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from dateparser.search import search_dates
 from dateutil import parser
-from fastapi import FastAPI, Body
-from sqlalchemy import and_
-from starlette.responses import JSONResponse
-
-from models import DATABASE_URL, reminders, intervals, timezone, Reminder, Email, Remove
+from fastapi import FastAPI, Body, Depends, Request
+from sqlalchemy import and_, select
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from admission import Admission, Health, Quota, busy_response
+from catch_up import find_missed_runs, late_marker, missed_once
+from compact import STREAM, ActiveReminders, Recipient
+from delivery import Outbox
+from models import DATABASE_URL, DEFAULT_REALM, read_only_url, reminders, intervals, timezone, Reminder, Email, Remove
+from offload import PoolBusy, parse_pool
+from profiling import PROFILE_MAX_SECONDS, is_admin, phase, profiler, slow_log
+from realms import load_realms
+from recurrence import load_spec, next_fire_times, spec_trigger, to_datetime
+from serialization import reminder_body, stream_rows
+from time_parser import convert_zone, get_task
+from writer import WRITE_TIMEOUT, GroupWriter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 urllib3.disable_warnings()
 
-database = databases.Database(DATABASE_URL)
+database = databases.Database(read_only_url(DATABASE_URL), uri=True, timeout=WRITE_TIMEOUT)
+writer = GroupWriter(DATABASE_URL)
+active_reminders = ActiveReminders()
 jobstores = {
-    "default": SQLAlchemyJobStore(url=DATABASE_URL)
+    "default": SQLAlchemyJobStore(url=DATABASE_URL, engine_options={"connect_args": {"timeout": WRITE_TIMEOUT}}),
+    "service": MemoryJobStore()
 }
-ZULIPRC = os.path.abspath(os.path.join(os.path.dirname(__file__), 'zuliprc'))
 schedule = AsyncIOScheduler(jobstores=jobstores)
-schedule.start()
-client = zulip.Client(config_file=ZULIPRC)
-ARGS_WEEK_DAY = {
-    "monday", "tuesday", "wednesday", "thursday", "friday",
-    "saturday", "sunday"
-}
-DAY_DICT = {"monday": "mon", "tuesday": "tue", "wednesday": "wed", "thursday": "thu", "friday": "fri",
-            "saturday": "sat", "sunday": "sun"}
-ARGS_INTERVAL = {"minute", "hour", "day", "week", "month", "minutes", "hours", "days", "weeks", "months"}
-FREQUENCY = {"second": 2, "2nd": 2, "2": 2, "3": 3, "two": 2, "three": 3, "3rd": 3, "third": 3, "4": 4, "4th": 4, "four": 4}
+schedule.start(paused=True)
+realms = load_realms()
+UNKNOWN_REALM = {"success": False, "result": "Unknown realm"}
+SCHEDULED_MESSAGES = os.environ.get("SCHEDULED_MESSAGES", "0") == "1"
 app = FastAPI()
 
 
@@ -53,20 +61,25 @@ async def test():
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    await writer.start()
     app.current_timezone = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo.utcoffset(None)
+    await load_active_reminders()
+    await catch_up()
+    if SCHEDULED_MESSAGES:
+        schedule.add_job(settle_scheduled_messages, "interval", minutes=10, jobstore="service")
+    schedule.resume()
+    health.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    health.stop()
+    await outbox.stop()
+    parse_pool.shutdown()
+    await writer.stop()
     await database.disconnect()
 
 
-def convert_zone(zone: float):
-    minutes, hour = modf(zone)
-    minutes *= 60
-    return int(hour), int(minutes)
-
-
 def reminder_insert_expression(reminder: Reminder):
     return reminders.insert().values(
         zulip_user_email=reminder.zulip_user_email,
@@ -80,25 +93,36 @@ def reminder_insert_expression(reminder: Reminder):
         topic=reminder.topic,
         to=reminder.to,
         text_date=reminder.text_date,
+        realm=reminder.realm,
     )
 
 
 @app.post("/add_reminder", response_class=JSONResponse)
-async def add_reminder(request: Reminder):
+async def add_reminder(request: Reminder = Depends(reminder_body)):
     logger.info(f"Simple reminder from {request.zulip_user_email}")
+    if request.realm not in realms:
+        return UNKNOWN_REALM
+    retry_after = quota.check(request.realm, request.zulip_user_email)
+    if retry_after:
+        return busy_response("Too many reminders created, try again later", retry_after, status_code=429)
     if not request.is_use_timezone:
         zone = 0.0
     else:
-        zone = await get_timezone(request.zulip_user_email)
+        zone = await get_timezone(request.zulip_user_email, request.realm)
     if zone is None:
         return {"success": False, "result": "Set timezone, see help"}
     hour, minutes = convert_zone(zone)
-    time = parser.parse(request.time) + datetime.timedelta(hours=hour, minutes=minutes)
+    with phase("parse"):
+        time = parser.parse(request.time) + datetime.timedelta(hours=hour, minutes=minutes)
     request.time = time.timestamp()
 
     query = reminder_insert_expression(request)
 
-    last_record_id = await database.execute(query)
+    last_record_id = await writer.execute(query)
+    quota.take(request.realm, request.zulip_user_email)
+    active_reminders.add(last_record_id, request)
+    if await offload_to_zulip(last_record_id, request, request.to, time):
+        return {"success": True, "result": last_record_id}
     schedule.add_job(
         send_reminder_to_me,
         "date",
@@ -109,107 +133,179 @@ async def add_reminder(request: Reminder):
     return {"success": True, "result": last_record_id}
 
 
+async def zulip_call(func, *args):
+    """Runs a blocking zulip API call in the default executor, like the outbox sends, phases still traced."""
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(context.run, func, *args))
+
+
+async def offload_to_zulip(reminder_id: int, reminder: Reminder, to, time: datetime.datetime) -> bool:
+    """One-time reminders are scheduled on the zulip server when SCHEDULED_MESSAGES is on,
+    falls back to a local job when the server refuses."""
+    if not SCHEDULED_MESSAGES:
+        return False
+    realm = realms[reminder.realm]
+    if not reminder.is_stream and not isinstance(to, int):
+        to = await zulip_call(realm.get_user_id, to)
+        if to is None:
+            return False
+    message = reminder_to_message(reminder, to)
+    if reminder.is_stream:
+        message["to"] = to
+    scheduled_message_id = await zulip_call(realm.schedule_message, message, time.timestamp())
+    if scheduled_message_id is None:
+        return False
+    update = reminders.update().where(reminders.c.id == reminder_id)
+    await writer.execute(update, values={"scheduled_message_id": scheduled_message_id})
+    logger.info(f"Scheduled on zulip, id = {reminder_id}, scheduled message id = {scheduled_message_id}")
+    return True
+
+
+async def settle_scheduled_messages():
+    """Reminders scheduled on the zulip server are completed once their time has passed."""
+    rows = await database.fetch_all(select([reminders.c.id]).where(and_(
+        reminders.c.scheduled_message_id.isnot(None), reminders.c.active == 1, reminders.c.stop_date <= clock.time()
+    )))
+    if not rows:
+        return
+    reminder_ids = [row.id for row in rows]
+    await writer.execute(reminders.update().where(reminders.c.id.in_(reminder_ids)), values={"active": 0})
+    for reminder_id in reminder_ids:
+        active_reminders.discard(reminder_id)
+
+
 async def get_reminder_by_id(reminder_id: int):
     query = reminders.select().where(reminders.c.id == reminder_id)
-    return await database.fetch_one(query=query)
+    with phase("db"):
+        return await database.fetch_one(query=query)
 
 
-async def send_reminder_to_me(reminder_id: int):
-    reminder = await get_reminder_by_id(reminder_id)
-    text = f"Reminder: :siren: {reminder.text}"
-    request = {
+ACTIVE_COLUMNS = [
+    reminders.c.id, reminders.c.zulip_user_email, reminders.c.text, reminders.c.to,
+    reminders.c.is_stream, reminders.c.is_interval, reminders.c.topic, reminders.c.realm, reminders.c.text_date,
+]
+
+
+async def load_active_reminders():
+    rows = await database.fetch_all(select(ACTIVE_COLUMNS).where(reminders.c.active == 1))
+    active_reminders.rebuild(rows)
+    logger.info(f"Loaded {len(active_reminders)} active reminders")
+
+
+async def get_active_reminder(reminder_id: int):
+    reminder = active_reminders.get(reminder_id)
+    if reminder is None:
+        reminder = await get_reminder_by_id(reminder_id)
+    return reminder
+
+
+def reminder_to_me_message(reminder):
+    return {
         "type": "private",
         "to": reminder.zulip_user_email,
-        "content": text
+        "content": f"Reminder: :siren: {reminder.text}"
     }
-    result = send_zulip_reminder(request)
+
+
+@slow_log.traced
+async def send_reminder_to_me(reminder_id: int):
+    reminder = await get_active_reminder(reminder_id)
+    request = reminder_to_me_message(reminder)
+    result = await outbox.deliver(reminder.realm, request)
     if result:
         update_active = reminders.update().where(reminders.c.id == reminder.id)
-        await database.execute(update_active, values={"active": 0})
+        await writer.execute(update_active, values={"active": 0})
+        active_reminders.discard(reminder.id)
         logger.info(f"Success sent to {reminder.zulip_user_email}, id = {reminder_id}")
     return result
 
 
-@app.post("/list_reminders", response_class=JSONResponse)
+LIST_REMINDERS = "SELECT id, full_content AS content, active, text_date FROM reminders " \
+                 "WHERE zulip_user_email = :email AND realm = :realm"
+
+
+@app.post("/list_reminders")
 async def list_reminders(request: Email):
-    response_reminders = []
-    # query = "SELECT * FROM reminders WHERE zulip_user_email = :zulip_user_email"
-    query = reminders.select().where(reminders.c.zulip_user_email == request.zulip_user_email)
-    user_reminders = await database.fetch_all(query)
-    for reminder in user_reminders:
-        data = {
-            "id": reminder.id,
-            "content": reminder.full_content,
-            "active": reminder.active,
-            "text_date": reminder.text_date,
-        }
-        response_reminders.append(data)
-    return {"success": True, "reminders_list": response_reminders}
+    values = {"email": request.zulip_user_email, "realm": request.realm}
+    return stream_rows(database, LIST_REMINDERS, values, "reminders_list")
 
 
 @app.post("/remove_reminder", response_class=JSONResponse)
 async def remove_reminder(request: Remove):
     query = reminders.select().where(
         and_(
-            reminders.c.id == request.id, reminders.c.zulip_user_email == request.email
+            reminders.c.id == request.id, reminders.c.zulip_user_email == request.email,
+            reminders.c.realm == request.realm
         )
     )
 
-    reminder = await database.fetch_one(query=query)
+    with phase("db"):
+        reminder = await database.fetch_one(query=query)
     if not reminder:
         return {"success": False}
     if reminder.is_interval:
-        await database.execute(intervals.delete(intervals.c.reminder_id == reminder.id))
+        await writer.execute(intervals.delete(intervals.c.reminder_id == reminder.id))
+    if reminder.scheduled_message_id is not None and reminder.realm in realms:
+        if not await zulip_call(realms[reminder.realm].delete_scheduled_message, reminder.scheduled_message_id):
+            logger.info(f"Scheduled message {reminder.scheduled_message_id} not deleted, probably it is sent")
     try:
         schedule.remove_job(str(reminder.id))
     except JobLookupError as e:
         logger.info(f"{e}, probably that job is finished")
-    await database.execute(reminders.delete(reminders.c.id == reminder.id))
+    await writer.execute(reminders.delete(reminders.c.id == reminder.id))
+    active_reminders.discard(reminder.id)
     return {"success": True}
 
 
 @app.post("/repeat_reminder", response_class=JSONResponse)
-async def repeat_reminder(request: Reminder):
+async def repeat_reminder(request: Reminder = Depends(reminder_body)):
     logger.info(f"Interval reminder from {request.zulip_user_email}")
+    realm = realms.get(request.realm)
+    if realm is None:
+        return UNKNOWN_REALM
+    retry_after = quota.check(request.realm, request.zulip_user_email)
+    if retry_after:
+        return busy_response("Too many reminders created, try again later", retry_after, status_code=429)
     if not request.is_use_timezone:
         zone = 0.0
     else:
-        zone = await get_timezone(request.zulip_user_email)
+        zone = await get_timezone(request.zulip_user_email, request.realm)
     if zone is None:
         return {"success": False, "result": "Set timezone, see help"}
 
     time = request.time
-    task = {}
     request.time = None
-    trigger = "cron"
 
     if isinstance(request.to, list):
         user = " ".join(request.to).replace("@", "").replace("**", "")
-        to = await get_user(user)
+        to = await get_user(user, realm)
     elif request.is_stream:
         to = request.to \
             if isinstance(request.to, int) \
-            else client.get_stream_id(request.to.replace("#", "").replace("**", ""))["stream_id"]
+            else realm.get_stream_id(request.to.replace("#", "").replace("**", ""))["stream_id"]
     else:
         to = request.to
     request.to = to
 
-    if isinstance(time, list):
-        task, trigger = get_time_from_list(time, task, zone)
-    if isinstance(time, str):
-        hour, minutes = convert_zone(zone)
-        time = parser.parse(time) + datetime.timedelta(hours=hour, minutes=minutes)
-        task["day_of_week"] = time.weekday()
-        task["hour"] = time.hour
-        task["minute"] = time.minute
+    try:
+        with phase("parse"):
+            task, trigger = await parse_pool.run(get_task, time, zone)
+    except PoolBusy:
+        return busy_response("Server is busy, try again in a minute")
+    except asyncio.TimeoutError:
+        logger.warning(f"Parse timeout: {time}")
+        return busy_response("Server is busy, try again in a minute")
     print(task)
     query = reminder_insert_expression(request)
-    last_record_id = await database.execute(query)
+    last_record_id = await writer.execute(query)
+    quota.take(request.realm, request.zulip_user_email)
+    active_reminders.add(last_record_id, request)
     interval_query = intervals.insert().values(
         reminder_id=last_record_id,
-        interval_time=json.dumps(task, default=str)
+        interval_time=json.dumps(task, default=str),
+        realm=request.realm,
     )
-    await database.execute(interval_query)
+    await writer.execute(interval_query)
     task.update(dict(
         args=[last_record_id, to, request.is_stream, request.topic],
         id=str(last_record_id)))
@@ -222,153 +318,153 @@ async def repeat_reminder(request: Reminder):
     return {"success": True, "result": last_record_id}
 
 
-def get_time_from_list(time: list, task: dict, zone):
-    if is_last_or_first_day_moth(time):
-        time[0] = time[0] if time[0] == "last" else 1
-        if all(i in time for i in ("day", "month")):
-            hours, minutes = convert_zone(zone)
-            task = {"year": "*", "month": "*", "day": time[0], "hour": 9 + hours, "minute": 0 + minutes}
-            if re.search(r"at \d{2}:\d{2}", " ".join(time)):
-                idx = time.index("at") + 1
-                hour, minute = time[idx].split(":")
-                task["hour"] = int(hour) + hours
-                task["minute"] = int(minute) + minutes
-            return task, "cron"
-    if any(i in ARGS_INTERVAL for i in time):
-        return get_interval_time(time, task, zone)
-
-    if sum(1 for i in time if i.lower().replace(",", "") in ARGS_WEEK_DAY) > 1:
-        return get_multiple_day_time(time, task, zone)
-    if "weekday" in time:
-        days = ["monday", "tuesday", "wednesday", "thursday", "friday"]
-        idx = time.index("weekday")
-        time[idx:idx] = days
-        time.remove("weekday")
-        return get_multiple_day_time(time, task, zone)
-    logger.warning(f"Time from list, unsupported type: {time}")
-
-
-def is_last_or_first_day_moth(time):
-    return time[0] in {"last", "first", "1st"}
-
-
-def get_multiple_day_time(time: list, task: dict, zone: float):
-    hour, minute = convert_zone(zone)
-    days = []
-    time_idx = None
-    for idx, i in enumerate(time):
-        i = i.replace(",", "").lower()
-        if i == "at":
-            time_idx = idx
-        if DAY_DICT.get(i) is not None:
-            days.append(DAY_DICT[i])
-    time = time[time_idx + 1]
-    date = datetime.datetime.strptime(time, "%H:%M")
-    date = date + datetime.timedelta(hours=hour, minutes=minute)
-    task["day_of_week"] = ",".join(days)
-    task["hour"] = date.hour
-    task["minute"] = date.minute
-    trigger = "cron"
-    return task, trigger
-
-
-def get_interval_time(time: list, task: dict, zone):
-    try:
-        frequency = int(time[0])
-    except ValueError:
-        frequency = FREQUENCY.get(time[0], 1)
-
-    idx = 0 if frequency == 1 else 1
-    if time[idx] in ARGS_INTERVAL:
-        interval = time[idx] if time[idx].endswith('s') else time[idx] + "s"
-        task[interval] = frequency
-    if "at" not in time:
-        time.insert(idx + 1, "at 9:00")
-    time = time[idx + 1::]
-    time, start = find_start_end(time, "start")
-    start, end = find_start_end(start, "end")
-    tuple_date = search_dates(" ".join(time), settings={"PREFER_DATES_FROM": "current_period"})
-    hour, minute = convert_zone(zone)
-    date: datetime = tuple_date[0][1] + datetime.timedelta(hours=hour, minutes=minute)
-    hours = date.hour
-    minutes = date.minute
-    if start:
-        start_date = search_dates(" ".join(start))[-1][-1]
-
-        start_date = start_date.replace(hour=hours, minute=minutes, second=0)
-        task["start_date"] = start_date
-    else:
-        date = date if date > datetime.datetime.now() else date + datetime.timedelta(**task)
-        task["start_date"] = date
-    if end:
-        end_date = search_dates(" ".join(end))[-1][-1]
-        end_date = end_date.replace(hour=hours, minute=minutes, second=0)
-        task["end_date"] = end_date
-
-    trigger = "interval"
-    if task.get("months") is not None:
-        trigger = "cron"
-        value = task["months"]
-        del task["months"]
-        interval_value = "*" if value == 1 else f"*/{value}"
-        task["month"] = interval_value
-
-    return task, trigger
-
-
-def find_start_end(time: list, value: str):
-    try:
-        idx = time.index(value)
-        return time[:idx], time[idx + 1:]
-    except ValueError:
-        return time, []
-
-
-async def send_interval_reminder(reminder_id: int, to: int, is_stream: bool, topic: Optional[str] = None):
-    reminder = await get_reminder_by_id(reminder_id)
-    content = f"Reminder: {reminder.text}"
+def interval_reminder_message(reminder, to: int, is_stream: bool, topic: Optional[str] = None):
     message = {
         "type": "stream" if is_stream else "private",
         "to": [to],
-        "content": content
+        "content": f"Reminder: {reminder.text}"
     }
     if is_stream:
         message["topic"] = topic
-    result = send_zulip_reminder(message)
+    return message
+
+
+@slow_log.traced
+async def send_interval_reminder(reminder_id: int, to: int, is_stream: bool, topic: Optional[str] = None):
+    reminder = await get_active_reminder(reminder_id)
+    message = interval_reminder_message(reminder, to, is_stream, topic)
+    result = await outbox.deliver(reminder.realm, message)
     if result:
         logger.info(f"Success sent to {to}, id = {reminder_id}")
 
 
-def send_zulip_reminder(message: dict):
-    response = client.send_message(message)
+def send_zulip_reminder(realm: str, message: dict):
+    response = realms[realm].send_message(message)
     logger.info(f"{response}")
     return response['result'] == 'success'
 
 
+async def complete_reminders(reminder_ids: list):
+    await writer.execute(reminders.update().where(reminders.c.id.in_(reminder_ids)), values={"active": 0})
+    for reminder_id in reminder_ids:
+        active_reminders.discard(reminder_id)
+    logger.info(f"Success sent late reminders, ids = {reminder_ids}")
+
+
+outbox = Outbox(send_zulip_reminder, on_delivered=complete_reminders)
+health = Health(schedule, jobstores["default"], outbox.depth)
+admission = Admission()
+quota = Quota()
+CREATE_PATHS = {"/add_reminder", "/add_to", "/repeat_reminder"}
+
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """Refuses requests over MAX_IN_FLIGHT, and new reminders while delivery is behind.
+    Health and admin requests are always let through, they are needed most when the server is busy."""
+    if request.url.path == "/health" or request.url.path.startswith("/admin/"):
+        return await call_next(request)
+    if admission.full():
+        logger.warning(f"Refuse {request.url.path}: {admission.in_flight} requests in flight")
+        return busy_response("Server is busy, try again in a minute")
+    if request.url.path in CREATE_PATHS:
+        reason = health.overloaded()
+        if reason is not None:
+            logger.warning(f"Refuse {request.url.path}: {reason}")
+            return busy_response("Reminders are running late, try again in a minute")
+    with admission:
+        return await call_next(request)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    if request.url.path.startswith("/admin/"):
+        return await call_next(request)
+    with slow_log.trace("request", f"{request.method} {request.url.path}") as trace:
+        response = await call_next(request)
+        if trace is not None:
+            trace.open = True
+            response.body_iterator = slow_log.finish_after(trace, response.body_iterator)
+    return response
+
+
+FORBIDDEN = {"success": False, "result": "Forbidden"}
+
+
+@app.get("/admin/profile")
+async def profile(request: Request, seconds: float = 10):
+    """Collapsed stacks of all threads sampled for `seconds`, at most PROFILE_MAX_SECONDS."""
+    if not is_admin(request.headers):
+        return JSONResponse(FORBIDDEN, status_code=403)
+    stacks = await profiler.profile(min(seconds, PROFILE_MAX_SECONDS))
+    if stacks is None:
+        return JSONResponse({"success": False, "result": "Profiler is already running"}, status_code=409)
+    return PlainTextResponse(stacks, headers={"Content-Disposition": 'attachment; filename="remindmoi.collapsed"'})
+
+
+@app.get("/admin/slow")
+async def slow_runs(request: Request):
+    if not is_admin(request.headers):
+        return JSONResponse(FORBIDDEN, status_code=403)
+    return {"success": True, **slow_log.settings(), "runs": list(slow_log.entries)}
+
+
+@app.post("/admin/slow")
+async def configure_slow_runs(request: Request, settings: dict = Body(...)):
+    """Turns capture of slow requests and jobs on or off, `{"enabled": true, "threshold": 0.5, "keep": 100}`."""
+    if not is_admin(request.headers):
+        return JSONResponse(FORBIDDEN, status_code=403)
+    slow_log.configure(settings.get("enabled"), settings.get("threshold"), settings.get("keep"))
+    return {"success": True, **slow_log.settings()}
+
+
+@app.get("/health")
+async def health_check():
+    status = health.snapshot()
+    status.update(in_flight=admission.in_flight, writer_queue=writer.queue.qsize())
+    reason = health.overloaded()
+    status["ready"] = reason is None
+    if reason is not None:
+        status["reason"] = reason
+        return JSONResponse(status, status_code=503)
+    return status
+
+
 @app.post("/add_to", response_class=JSONResponse)
-async def add_reminder_to_person(request: Reminder):
+async def add_reminder_to_person(request: Reminder = Depends(reminder_body)):
     logger.info(f"Reminder to someone from {request.zulip_user_email}")
+    realm = realms.get(request.realm)
+    if realm is None:
+        return UNKNOWN_REALM
+    retry_after = quota.check(request.realm, request.zulip_user_email)
+    if retry_after:
+        return busy_response("Too many reminders created, try again later", retry_after, status_code=429)
     if not request.is_use_timezone:
         zone = 0.0
     else:
-        zone = await get_timezone(request.zulip_user_email)
+        zone = await get_timezone(request.zulip_user_email, request.realm)
     if zone is None:
         return {"success": False, "result": "Set timezone, see help"}
     hour, minutes = convert_zone(zone)
-    time = parser.parse(request.time) + datetime.timedelta(hours=hour, minutes=minutes)
+    with phase("parse"):
+        time = parser.parse(request.time) + datetime.timedelta(hours=hour, minutes=minutes)
     request.time = time.timestamp()
     if request.is_stream:
         try:
-            to = request.to if isinstance(request.to, int) else client.get_stream_id(request.to)["stream_id"]
+            to = request.to if isinstance(request.to, int) else realm.get_stream_id(request.to)["stream_id"]
         except KeyError:
             return {"success": False, "result": "Invite reminder to stream or create reminder inside stream"}
     else:
         name = " ".join(request.to).replace("@", "").replace("**", "")
-        to = await get_user(name)
+        to = await get_user(name, realm)
 
     request.to = to
     query = reminder_insert_expression(request)
-    last_record_id = await database.execute(query)
+    last_record_id = await writer.execute(query)
+    quota.take(request.realm, request.zulip_user_email)
+    active_reminders.add(last_record_id, request)
+    if await offload_to_zulip(last_record_id, request, to, time):
+        return {"success": True, "result": last_record_id}
     schedule.add_job(
         send_reminder_to,
         "date",
@@ -379,30 +475,99 @@ async def add_reminder_to_person(request: Reminder):
     return {"success": True, "result": last_record_id}
 
 
-async def send_reminder_to(reminder_id, to):
-    reminder = await get_reminder_by_id(reminder_id)
-    text = f"Reminder: :siren: {reminder.text}"
+def reminder_to_message(reminder, to):
     request = {
         "type": "private" if not reminder.is_stream else "stream",
         "to": [to],
-        "content": text
+        "content": f"Reminder: :siren: {reminder.text}"
     }
     if reminder.is_stream:
         request["topic"] = reminder.topic
-    result = send_zulip_reminder(request)
+    return request
+
+
+@slow_log.traced
+async def send_reminder_to(reminder_id, to):
+    reminder = await get_active_reminder(reminder_id)
+    request = reminder_to_message(reminder, to)
+    result = await outbox.deliver(reminder.realm, request)
     if result:
         update_active = reminders.update().where(reminders.c.id == reminder.id)
-        await database.execute(update_active, values={"active": 0})
+        await writer.execute(update_active, values={"active": 0})
+        active_reminders.discard(reminder.id)
         logger.info(f"Success sent to {to}, id = {reminder_id}")
     return result
 
 
+MESSAGE_BUILDERS = {
+    "send_reminder_to_me": reminder_to_me_message,
+    "send_reminder_to": reminder_to_message,
+    "send_interval_reminder": interval_reminder_message,
+}
+
+
+async def catch_up():
+    now = datetime.datetime.now(schedule.timezone)
+    jobs = schedule.get_jobs("default")
+    expired = await catch_up_unscheduled({job.id for job in jobs}, now)
+    specs = {str(row.reminder_id): row.interval_time for row in await database.fetch_all(intervals.select())}
+    missed = find_missed_runs(jobs, now, specs)
+    for run in missed:
+        reminder = active_reminders.get(int(run.job.id))
+        if reminder is not None and run.in_grace:
+            message = MESSAGE_BUILDERS[run.job.func.__name__](reminder, *run.job.args[1:])
+            message["content"] += late_marker(run)
+            outbox.put(reminder.realm, message, reminder.id if run.kind == "once" else None)
+        else:
+            logger.info(f"Skip missed reminder id = {run.job.id}, was due {run.last}")
+            if run.kind == "once":
+                expired.append(int(run.job.id))
+        if run.next_run_time is None:
+            schedule.remove_job(run.job.id)
+        else:
+            run.job.modify(next_run_time=run.next_run_time)
+    if expired:
+        await writer.execute(reminders.update().where(reminders.c.id.in_(expired)), values={"active": 0})
+        for reminder_id in expired:
+            active_reminders.discard(reminder_id)
+    logger.info(f"Catch up: {len(missed)} missed reminders, {len(expired)} expired, {outbox.depth()} queued")
+
+
+async def catch_up_unscheduled(job_ids: set, now: datetime.datetime) -> list:
+    """Active one-time reminders without a job were taken by the scheduler but not sent before the
+    last shutdown: sent late within the grace, rescheduled if still due later. Returns the expired ones."""
+    rows = await database.fetch_all(select([reminders.c.id, reminders.c.stop_date]).where(and_(
+        reminders.c.active == 1, reminders.c.is_interval.is_(False), reminders.c.scheduled_message_id.is_(None)
+    )))
+    expired = []
+    for row in rows:
+        reminder = active_reminders.get(row.id)
+        if str(row.id) in job_ids or reminder is None or row.stop_date is None:
+            continue
+        due = datetime.datetime.fromtimestamp(row.stop_date, schedule.timezone)
+        if due > now:
+            schedule.add_job(send_reminder_to, "date", run_date=due, args=[reminder.id, reminder.to],
+                             id=str(reminder.id))
+            continue
+        run = missed_once(due, now)
+        if run.in_grace:
+            message = reminder_to_message(reminder, reminder.to)
+            message["content"] += late_marker(run)
+            outbox.put(reminder.realm, message, reminder.id)
+        else:
+            logger.info(f"Skip unsent reminder id = {reminder.id}, was due {due}")
+            expired.append(reminder.id)
+    return expired
+
+
 @app.post("/timezone", response_class=JSONResponse)
 async def set_timezone(request: dict = Body(...)):
-    check = "SELECT * FROM timezones WHERE email = :email"
-    user = await database.fetch_one(
-        check, values={"email": request["email"]}
-    )
+    realm = request.get("realm", DEFAULT_REALM)
+    check = "SELECT * FROM timezones WHERE email = :email AND realm = :realm"
+    with phase("db"):
+        user = await database.fetch_one(
+            check, values={"email": request["email"], "realm": realm}
+        )
     if user:
         query = timezone.update().values(
             zone=request["timezone"]
@@ -410,23 +575,25 @@ async def set_timezone(request: dict = Body(...)):
     else:
         query = timezone.insert().values(
             email=request["email"],
-            zone=request["timezone"]
+            zone=request["timezone"],
+            realm=realm
         )
-    await database.execute(query)
+    await writer.execute(query)
     return {"success": True}
 
 
-async def get_timezone(email):
-    query = "SELECT zone FROM timezones WHERE email = :email"
-    zone = await database.fetch_one(query=query, values={"email": email})
+async def get_timezone(email, realm=DEFAULT_REALM):
+    query = "SELECT zone FROM timezones WHERE email = :email AND realm = :realm"
+    with phase("db"):
+        zone = await database.fetch_one(query=query, values={"email": email, "realm": realm})
     if not zone:
         return
     return (app.current_timezone - datetime.datetime.now(
         pytz.timezone(zone[0])).utcoffset()).total_seconds() / 3600
 
 
-async def get_user(full_name):
-    members = client.get_members()['members']
+async def get_user(full_name, realm):
+    members = realm.get_members()
     for user in members:
         if full_name == user["full_name"]:
             return user["email"]
@@ -434,46 +601,44 @@ async def get_user(full_name):
 
 @app.get("/restore")
 async def restore_jobs():
-    rem_expr = reminders.select().where(reminders.c.active == 1)
-    all_reminders = await database.fetch_all(rem_expr)
+    await load_active_reminders()
     int_expr = intervals.select()
-    all_intervals = await database.fetch_all(int_expr)
-    all_reminders = {i.id: i for i in all_reminders}
+    all_intervals = [i for i in await database.fetch_all(int_expr) if active_reminders.get(i.reminder_id)]
     schedule.remove_all_jobs("default")
-    for i in all_intervals:
-        trigger = "cron"
-        task = json.loads(i.interval_time.replace("'", "\""))
-        if task.get("day_of_week") is None and task.get("month") is None:
-            trigger = "interval"
-        reminder = all_reminders.get(i.reminder_id)
+    fire_times = next_fire_times([i.interval_time for i in all_intervals],
+                                 datetime.datetime.now(schedule.timezone), 1, schedule.timezone)
+    for i, fire_time in zip(all_intervals, fire_times[:, 0]):
+        task = load_spec(i.interval_time)
+        trigger = spec_trigger(task)
+        reminder = active_reminders.get(i.reminder_id)
         task.update(dict(
             args=[reminder.id, reminder.to, reminder.is_stream, reminder.topic],
             id=str(reminder.id)))
+        next_run_time = to_datetime(fire_time, schedule.timezone)
+        if next_run_time is not None:
+            task["next_run_time"] = next_run_time
         schedule.add_job(
             send_interval_reminder,
             trigger,
             **task
         )
-        # del all_reminders[reminder.id]
-
-    # for key, reminder in all_reminders.items():
 
 
 @app.get("/who")
-async def who_creator(stream_name: str):
-    try:
-        stream_id = client.get_stream_id(
-            stream_name.replace("#", "").replace("**", "")
-        )["stream_id"]
-    except KeyError:
-        return {"success": False, "error": "Probably bot not in this private stream as member"}
-    stream_reminders = await database.fetch_all(reminders.select().where(
-        and_(
-            reminders.c.to == stream_id, reminders.c.active == 1
-        )
-    ))
+async def who_creator(stream_name: Optional[str] = None, realm: str = DEFAULT_REALM, stream_id: Optional[int] = None):
+    if realm not in realms:
+        return {"success": False, "error": "Unknown realm"}
+    if stream_id is None:
+        if not stream_name:
+            return {"success": False, "error": "Write who #stream or who inside a stream"}
+        try:
+            stream_id = realms[realm].get_stream_id(
+                stream_name.replace("#", "").replace("**", "")
+            )["stream_id"]
+        except KeyError:
+            return {"success": False, "error": "Probably bot not in this private stream as member"}
     response_reminders = []
-    for reminder in stream_reminders:
+    for reminder in active_reminders.for_recipient(Recipient(realm, STREAM, stream_id)):
         data = {
             "id": reminder.id,
             "owner": reminder.zulip_user_email,
@@ -482,3 +647,38 @@ async def who_creator(stream_name: str):
         }
         response_reminders.append(data)
     return {"success": True, "reminders": response_reminders}
+
+
+@app.post("/admin/stream_deleted")
+async def stream_deleted(request: Request, body: dict = Body(...)):
+    """Deactivates the reminders of a deleted stream, `{"stream_id": 12, "realm": "default"}`.
+
+    Called by an admin only, nothing listens to Zulip's stream deletion events.
+    """
+    if not is_admin(request.headers):
+        return JSONResponse(FORBIDDEN, status_code=403)
+    realm = body.get("realm", DEFAULT_REALM)
+    reminder_ids = active_reminders.ids_for(Recipient(realm, STREAM, int(body["stream_id"])))
+    if reminder_ids:
+        await deactivate_reminders(reminder_ids, realm)
+    logger.info(f"Stream {body['stream_id']} deleted in {realm}, deactivated reminders {reminder_ids}")
+    return {"success": True, "result": len(reminder_ids)}
+
+
+async def deactivate_reminders(reminder_ids: list, realm: str):
+    scheduled = await database.fetch_all(select([reminders.c.scheduled_message_id]).where(and_(
+        reminders.c.id.in_(reminder_ids), reminders.c.scheduled_message_id.isnot(None)
+    )))
+    if realm in realms:
+        await asyncio.gather(*[
+            zulip_call(realms[realm].delete_scheduled_message, row.scheduled_message_id) for row in scheduled
+        ])
+    for reminder_id in reminder_ids:
+        try:
+            schedule.remove_job(str(reminder_id))
+        except JobLookupError:
+            pass
+    await writer.execute(intervals.delete(intervals.c.reminder_id.in_(reminder_ids)))
+    await writer.execute(reminders.update().where(reminders.c.id.in_(reminder_ids)), values={"active": 0})
+    for reminder_id in reminder_ids:
+        active_reminders.discard(reminder_id)
@@ -1,4 +1,5 @@
 import logging
+import os
 import re
 from datetime import timedelta, datetime
 from typing import Dict, Any
@@ -16,6 +17,8 @@ ARGS_WEEK_DAY = {
 }
 
 ENDPOINT_URL = "http://127.0.0.1:8000"
+REALM = os.environ.get("ZULIP_REALM", "default")
+INTERNAL_TOKEN = os.environ.get("INTERNAL_TOKEN")
 ADD_ENDPOINT = ENDPOINT_URL + '/add_reminder'
 REMOVE_ENDPOINT = ENDPOINT_URL + '/remove_reminder'
 LIST_ENDPOINT = ENDPOINT_URL + '/list_reminders'
@@ -23,6 +26,7 @@ REPEAT_ENDPOINT = ENDPOINT_URL + '/repeat_reminder'
 ADD_TO_ENDPOINT = ENDPOINT_URL + "/add_to"
 SET_TIMEZONE = ENDPOINT_URL + "/timezone"
 WHO_ENDPOINT = ENDPOINT_URL + "/who"
+BUSY_STATUS = (429, 503)
 send_to = {"me": lambda x, o: (x, o["sender_id"]),
            "here": lambda x, o: (True, o["stream_id"]) if o["type"] == "stream" else send_to["me"](x, o)}
 
@@ -212,3 +216,24 @@ def generate_who_list(reminders: dict):
     for reminder in reminders:
         full_text += f"\n{reminder['id']} | {reminder['owner']} | {reminder['content']} | {reminder['text_date']}"
     return full_text
+
+
+class ServerBusy(Exception):
+    def __init__(self, retry_after: int, quota_exceeded: bool):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+        self.quota_exceeded = quota_exceeded
+
+
+def raise_if_busy(response, *args, **kwargs):
+    """requests response hook, the server answers 503 under load and 429 over the creation quota."""
+    if response.status_code in BUSY_STATUS:
+        retry_after = response.headers.get("Retry-After", "60")
+        raise ServerBusy(int(retry_after) if retry_after.isdigit() else 60, response.status_code == 429)
+
+
+def busy_message(busy: ServerBusy) -> str:
+    wait = "a minute" if busy.retry_after <= 60 else f"{-(-busy.retry_after // 60)} minutes"
+    if busy.quota_exceeded:
+        return f"You created a lot of reminders recently, try again in {wait}."
+    return f"I am busy right now, try again in {wait}."
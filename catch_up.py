@@ -0,0 +1,110 @@
+import datetime
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+from apscheduler.job import Job
+from apscheduler.triggers.date import DateTrigger
+
+from recurrence import next_fire_times, to_datetime
+
+CATCH_UP_GRACE = {
+    "once": datetime.timedelta(seconds=int(os.environ.get("CATCH_UP_GRACE_ONCE", 12 * 3600))),
+    "interval": datetime.timedelta(seconds=int(os.environ.get("CATCH_UP_GRACE_INTERVAL", 3600))),
+}
+MAX_MISSED_RUNS = 1000
+CATCH_UP_BATCH = 16
+
+
+class MissedRun(NamedTuple):
+    job: Job
+    kind: str
+    count: int
+    last: datetime.datetime
+    next_run_time: Optional[datetime.datetime]
+    in_grace: bool
+
+
+def reminder_kind(job: Job) -> str:
+    return "once" if isinstance(job.trigger, DateTrigger) else "interval"
+
+
+def find_missed_runs(jobs: List[Job], now: datetime.datetime, specs: Optional[Dict[str, str]] = None) -> List[MissedRun]:
+    """Collapse every occurrence of a job that should have fired before `now` into one MissedRun.
+
+    Recurring jobs with their `intervals.interval_time` in `specs`, by job id, are counted together
+    with `next_fire_times`, the others one trigger call at a time.
+    """
+    specs = specs or {}
+    overdue = [job for job in jobs if job.next_run_time is not None and job.next_run_time <= now]
+    batch = [job for job in overdue if job.id in specs and reminder_kind(job) == "interval"]
+    missed = {run.job.id: run for run in batch_missed_runs(batch, specs, now)}
+    for job in overdue:
+        if job.id not in missed:
+            missed[job.id] = missed_run(job, now)
+    return [missed[job.id] for job in overdue]
+
+
+def missed_run(job: Job, now: datetime.datetime) -> MissedRun:
+    run_time = job.next_run_time
+    count, last = 0, None
+    while run_time is not None and run_time <= now and count < MAX_MISSED_RUNS:
+        count, last = count + 1, run_time
+        run_time = job.trigger.get_next_fire_time(run_time, now)
+    kind = reminder_kind(job)
+    if kind == "once":
+        run_time = None
+    elif run_time is not None and run_time <= now:
+        run_time = job.trigger.get_next_fire_time(None, now)
+    return MissedRun(job, kind, count, last, run_time, now - last <= CATCH_UP_GRACE[kind])
+
+
+def batch_missed_runs(jobs: List[Job], specs: Dict[str, str], now: datetime.datetime) -> List[MissedRun]:
+    """Missed runs of recurring jobs from their stored specs, CATCH_UP_BATCH fire times per job and round.
+
+    A job whose spec doesn't fire at its next_run_time is left out, it's counted from its trigger.
+    """
+    by_timezone = {}
+    for job in jobs:
+        by_timezone.setdefault(job.trigger.timezone, []).append(job)
+    missed = []
+    for timezone, group in by_timezone.items():
+        specs_of = [specs[job.id] for job in group]
+        since = [job.next_run_time for job in group]
+        counts, last, after = [0] * len(group), [None] * len(group), [None] * len(group)
+        pending = [i for i, fire_time in enumerate(next_fire_times(specs_of, since, 1, timezone)[:, 0])
+                   if to_datetime(fire_time, timezone) == group[i].next_run_time]
+        described = set(pending)
+        while pending:
+            fire_times = next_fire_times([specs_of[i] for i in pending], [since[i] for i in pending],
+                                         CATCH_UP_BATCH, timezone)
+            left = []
+            for i, row in zip(pending, fire_times):
+                known = [to_datetime(fire_time, timezone) for fire_time in row if not np.isnat(fire_time)]
+                due = [fire_time for fire_time in known if fire_time <= now][:MAX_MISSED_RUNS - counts[i]]
+                counts[i] += len(due)
+                last[i] = due[-1] if due else last[i]
+                if len(due) == CATCH_UP_BATCH and counts[i] < MAX_MISSED_RUNS:
+                    since[i] = last[i] + datetime.timedelta(microseconds=1)
+                    left.append(i)
+                elif len(known) > len(due) and known[len(due)] > now:
+                    after[i] = known[len(due)]
+            pending = left
+        capped = [i for i in described if counts[i] >= MAX_MISSED_RUNS and after[i] is None]
+        if capped:
+            for i, fire_time in zip(capped, next_fire_times([specs_of[i] for i in capped], now, 1, timezone)[:, 0]):
+                after[i] = to_datetime(fire_time, timezone)
+        for i in sorted(described):
+            missed.append(MissedRun(group[i], "interval", counts[i], last[i], after[i],
+                                    now - last[i] <= CATCH_UP_GRACE["interval"]))
+    return missed
+
+
+def missed_once(due: datetime.datetime, now: datetime.datetime) -> MissedRun:
+    """One-time reminder still active without a job, its message was queued but not sent before a shutdown."""
+    return MissedRun(None, "once", 1, due, None, now - due <= CATCH_UP_GRACE["once"])
+
+
+def late_marker(run: MissedRun) -> str:
+    times = f", missed {run.count} times" if run.count > 1 else ""
+    return f" (late{times}, was due {run.last:%b %d at %H:%M})"
@@ -0,0 +1,210 @@
+import sys
+import tracemalloc
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Union
+
+IS_STREAM = 1
+IS_INTERVAL = 2
+TO_TEXT = 4
+STREAM = "stream"
+USER = "user"
+EMAIL = "email"
+
+
+class TextTable:
+    """Interned strings referenced by index, every distinct text is stored once.
+
+    Texts are counted, one `release` per `add`, a text nobody references is dropped and its slot reused.
+    """
+    __slots__ = ("texts", "ids", "counts", "free")
+
+    def __init__(self):
+        self.texts: List[Optional[str]] = []
+        self.ids: Dict[str, int] = {}
+        self.counts: List[int] = []
+        self.free: List[int] = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, text: Optional[str]) -> int:
+        if text is None:
+            return -1
+        ref = self.ids.get(text)
+        if ref is None:
+            if self.free:
+                ref = self.free.pop()
+                self.texts[ref] = sys.intern(text)
+            else:
+                ref = len(self.texts)
+                self.texts.append(sys.intern(text))
+                self.counts.append(0)
+            self.ids[text] = ref
+        self.counts[ref] += 1
+        return ref
+
+    def release(self, ref: int):
+        if ref < 0:
+            return
+        self.counts[ref] -= 1
+        if not self.counts[ref]:
+            del self.ids[self.texts[ref]]
+            self.texts[ref] = None
+            self.free.append(ref)
+
+    def get(self, ref: int) -> Optional[str]:
+        return None if ref < 0 else self.texts[ref]
+
+
+class CompactReminder:
+    __slots__ = ("to", "flags", "topic", "text", "email", "realm", "text_date")
+
+    def __init__(self, to: int, flags: int, topic: int, text: int, email: int, realm: int, text_date: int):
+        self.to = to
+        self.flags = flags
+        self.topic = topic
+        self.text = text
+        self.email = email
+        self.realm = realm
+        self.text_date = text_date
+
+
+class Recipient(NamedTuple):
+    """`to` of a reminder typed: a stream id, a zulip user id or a user email."""
+    realm: str
+    kind: str
+    id: Union[int, str]
+
+
+def recipient_of(realm: str, to: Union[int, str], is_stream: bool) -> Recipient:
+    if is_stream:
+        return Recipient(realm, STREAM, to)
+    if isinstance(to, int):
+        return Recipient(realm, USER, to)
+    return Recipient(realm, EMAIL, to)
+
+
+class ReminderView(NamedTuple):
+    id: int
+    zulip_user_email: str
+    text: str
+    to: Union[int, str]
+    is_stream: bool
+    is_interval: bool
+    topic: Optional[str]
+    realm: str
+    text_date: Optional[str]
+
+
+class ActiveReminders:
+    """What the scheduler needs to send active reminders, wide columns stay in the DB.
+
+    Also indexes active reminders by recipient, so reminders of a stream are found without the DB.
+    """
+
+    def __init__(self):
+        self.texts = TextTable()
+        self.records: Dict[int, CompactReminder] = {}
+        self.by_recipient: Dict[Recipient, Set[int]] = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, reminder_id: int, reminder: Any):
+        self.discard(reminder_id)
+        to = reminder.to
+        flags = (IS_STREAM if reminder.is_stream else 0) | (IS_INTERVAL if reminder.is_interval else 0)
+        if not isinstance(to, int):
+            to, flags = self.texts.add(str(to)), flags | TO_TEXT
+        record = self.records[reminder_id] = CompactReminder(
+            to, flags, self.texts.add(reminder.topic), self.texts.add(reminder.text),
+            self.texts.add(reminder.zulip_user_email), self.texts.add(reminder.realm),
+            self.texts.add(reminder.text_date)
+        )
+        self.by_recipient.setdefault(self.recipient(record), set()).add(reminder_id)
+
+    def rebuild(self, rows: Iterable):
+        self.texts = TextTable()
+        self.records = {}
+        self.by_recipient = {}
+        for row in rows:
+            self.add(row.id, row)
+
+    def discard(self, reminder_id: int):
+        record = self.records.pop(reminder_id, None)
+        if record is None:
+            return
+        recipient = self.recipient(record)
+        reminder_ids = self.by_recipient[recipient]
+        reminder_ids.discard(reminder_id)
+        if not reminder_ids:
+            del self.by_recipient[recipient]
+        for ref in (record.topic, record.text, record.email, record.realm, record.text_date):
+            self.texts.release(ref)
+        if record.flags & TO_TEXT:
+            self.texts.release(record.to)
+
+    def recipient(self, record: CompactReminder) -> Recipient:
+        to = self.texts.get(record.to) if record.flags & TO_TEXT else record.to
+        return recipient_of(self.texts.get(record.realm), to, bool(record.flags & IS_STREAM))
+
+    def ids_for(self, recipient: Recipient) -> List[int]:
+        return sorted(self.by_recipient.get(recipient, ()))
+
+    def for_recipient(self, recipient: Recipient) -> List[ReminderView]:
+        return [self.get(reminder_id) for reminder_id in self.ids_for(recipient)]
+
+    def get(self, reminder_id: int) -> Optional[ReminderView]:
+        record = self.records.get(reminder_id)
+        if record is None:
+            return None
+        text = self.texts.get
+        return ReminderView(
+            reminder_id, text(record.email), text(record.text),
+            text(record.to) if record.flags & TO_TEXT else record.to,
+            bool(record.flags & IS_STREAM), bool(record.flags & IS_INTERVAL),
+            text(record.topic), text(record.realm), text(record.text_date),
+        )
+
+
+def measure(count: int = 100000) -> Dict[str, float]:
+    """Bytes per reminder held by ActiveReminders against one dict per full row."""
+
+    class Row(NamedTuple):
+        id: int
+        zulip_user_email: str
+        text: str
+        created: float
+        full_content: str
+        is_interval: bool
+        is_stream: bool
+        stop_date: float
+        active: int
+        topic: str
+        to: int
+        text_date: str
+        realm: str
+
+    def rows():
+        for i in range(count):
+            yield Row(i, f"user{i % 500}@example.com", f"standup number {i % 2000}", 1.6e9 + i,
+                      f"#**team {i % 100}** to standup number {i % 2000} every weekday at 10:00",
+                      bool(i % 2), bool(i % 3), 1.6e9 + i, 1, "reminder", i % 1000,
+                      "every weekday at 10:00", "default")
+
+    result = {}
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    full_rows = {row.id: row._asdict() for row in rows()}
+    result["full_rows"] = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(start, "filename"))
+    del full_rows
+    start = tracemalloc.take_snapshot()
+    active = ActiveReminders()
+    active.rebuild(rows())
+    result["compact"] = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(start, "filename"))
+    tracemalloc.stop()
+    return {key: value / count for key, value in result.items()}
+
+
+if __name__ == "__main__":
+    for name, size in measure().items():
+        print(f"{name}: {size:.0f} bytes per reminder, {size * 100000 / 2 ** 20:.1f} MiB per 100k")
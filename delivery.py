@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from profiling import add_time, current_trace
+
+logger = logging.getLogger()
+
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", 3))
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_STOP_TIMEOUT = float(os.environ.get("OUTBOX_STOP_TIMEOUT", 10))
+
+
+class Outbox:
+    """Queue of zulip messages sent in batches with at most `rate` messages per second per realm.
+
+    Every realm has its own lane, so a realm with a burst of reminders does not delay the others.
+    `send(realm, message)` is the synchronous zulip send function, it runs in the default executor so
+    a slow zulip API does not block the event loop. After every batch `on_delivered` gets the keys
+    of successfully sent messages, so callers can update the DB once per batch.
+    A message put while a request or job is traced adds its wait in the lane to the `outbox` phase
+    and its send to the `zulip` phase.
+    """
+
+    def __init__(self, send: Callable[[str, dict], bool],
+                 on_delivered: Optional[Callable[[List[int]], Awaitable[None]]] = None,
+                 rate: float = OUTBOX_RATE, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.send = send
+        self.on_delivered = on_delivered
+        self.rate = rate
+        self.batch_size = batch_size
+        self.lanes: Dict[str, asyncio.Queue] = {}
+        self.tasks: Dict[str, asyncio.Future] = {}
+
+    def lane(self, realm: str) -> asyncio.Queue:
+        if realm not in self.lanes:
+            self.lanes[realm] = asyncio.Queue()
+            self.tasks[realm] = asyncio.ensure_future(self.run(realm))
+        return self.lanes[realm]
+
+    def put(self, realm: str, message: dict, key: Optional[int] = None, future: Optional[asyncio.Future] = None):
+        self.lane(realm).put_nowait((message, key, future, current_trace.get(), time.perf_counter()))
+
+    async def deliver(self, realm: str, message: dict) -> bool:
+        future = asyncio.get_event_loop().create_future()
+        self.put(realm, message, future=future)
+        return await future
+
+    def depth(self) -> int:
+        return sum(lane.qsize() for lane in self.lanes.values())
+
+    async def stop(self, timeout: float = OUTBOX_STOP_TIMEOUT):
+        """Sends what is queued for at most `timeout` seconds. One-time reminders left unsent stay
+        active in the DB and are sent by the catch up at the next start."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*[lane.join() for lane in self.lanes.values()]), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbox stopped with {self.depth()} messages unsent")
+        for task in self.tasks.values():
+            task.cancel()
+        for lane in self.lanes.values():
+            while not lane.empty():
+                _, _, future, _, _ = lane.get_nowait()
+                if future is not None and not future.done():
+                    future.set_result(False)
+        self.lanes, self.tasks = {}, {}
+
+    async def run(self, realm: str):
+        loop = asyncio.get_event_loop()
+        lane = self.lanes[realm]
+        while True:
+            batch = [await lane.get()]
+            while len(batch) < self.batch_size and not lane.empty():
+                batch.append(lane.get_nowait())
+            delivered = []
+            for message, key, future, trace, queued in batch:
+                started = loop.time()
+                sending = time.perf_counter()
+                add_time(trace, "outbox", sending - queued)
+                result = False
+                try:
+                    result = await loop.run_in_executor(None, self.send, realm, message)
+                except Exception as e:
+                    logger.error(f"Outbox send to {realm} failed {e}")
+                add_time(trace, "zulip", time.perf_counter() - sending)
+                if result and key is not None:
+                    delivered.append(key)
+                if future is not None and not future.done():
+                    future.set_result(result)
+                await asyncio.sleep(max(0.0, 1 / self.rate - (loop.time() - started)))
+            try:
+                if delivered and self.on_delivered is not None:
+                    await self.on_delivered(delivered)
+            except Exception as e:
+                logger.error(f"Outbox delivered callback failed {e}")
+            finally:
+                for _ in batch:
+                    lane.task_done()
@@ -0,0 +1,89 @@
+"""Stand-in zulip server for local runs.
+
+`uvicorn fake_zulip:app --port 9991` and a zuliprc with `site=http://127.0.0.1:9991`,
+run one per realm on different ports. Sent messages are listed on `GET /fake/messages`,
+scheduled messages move there once their delivery time has passed.
+"""
+import itertools
+import json
+import os
+import time
+from urllib.parse import parse_qsl
+
+from fastapi import FastAPI, Request
+
+FAKE_ZULIP_MEMBERS = json.loads(os.environ.get("FAKE_ZULIP_MEMBERS", "[]"))
+FAKE_ZULIP_STREAMS = json.loads(os.environ.get("FAKE_ZULIP_STREAMS", '{"general": 1}'))
+FAKE_ZULIP_VERSION = os.environ.get("FAKE_ZULIP_VERSION", "7.0")
+FAKE_ZULIP_FEATURE_LEVEL = int(os.environ.get("FAKE_ZULIP_FEATURE_LEVEL", 185))
+
+app = FastAPI()
+app.messages = []
+app.scheduled = {}
+app.scheduled_ids = itertools.count(1)
+
+
+async def form(request: Request) -> dict:
+    data = dict(parse_qsl((await request.body()).decode()))
+    for key, value in data.items():
+        try:
+            data[key] = json.loads(value)
+        except ValueError:
+            pass
+    return data
+
+
+@app.get("/api/v1/server_settings")
+async def server_settings():
+    """Fetched by every zulip.Client when it is created."""
+    return {
+        "result": "success", "msg": "", "zulip_version": FAKE_ZULIP_VERSION,
+        "zulip_feature_level": FAKE_ZULIP_FEATURE_LEVEL, "push_notifications_enabled": False,
+    }
+
+
+@app.post("/api/v1/messages")
+async def send_message(request: Request):
+    message = await form(request)
+    message["id"] = len(app.messages) + 1
+    app.messages.append(message)
+    return {"result": "success", "msg": "", "id": message["id"]}
+
+
+@app.get("/api/v1/users")
+async def get_members():
+    return {"result": "success", "msg": "", "members": FAKE_ZULIP_MEMBERS}
+
+
+@app.get("/api/v1/get_stream_id")
+async def get_stream_id(stream: str):
+    if stream not in FAKE_ZULIP_STREAMS:
+        return {"result": "error", "msg": f"Invalid stream name '{stream}'", "code": "BAD_REQUEST"}
+    return {"result": "success", "msg": "", "stream_id": FAKE_ZULIP_STREAMS[stream]}
+
+
+@app.post("/api/v1/scheduled_messages")
+async def create_scheduled_message(request: Request):
+    message = await form(request)
+    if message["scheduled_delivery_timestamp"] <= time.time():
+        return {"result": "error", "msg": "Scheduled delivery time must be in the future.", "code": "BAD_REQUEST"}
+    scheduled_message_id = next(app.scheduled_ids)
+    app.scheduled[scheduled_message_id] = message
+    return {"result": "success", "msg": "", "scheduled_message_id": scheduled_message_id}
+
+
+@app.delete("/api/v1/scheduled_messages/{scheduled_message_id}")
+async def delete_scheduled_message(scheduled_message_id: int):
+    if app.scheduled.pop(scheduled_message_id, None) is None:
+        return {"result": "error", "msg": "Scheduled message does not exist", "code": "BAD_REQUEST"}
+    return {"result": "success", "msg": ""}
+
+
+@app.get("/fake/messages")
+async def sent_messages():
+    for scheduled_message_id, message in list(app.scheduled.items()):
+        if message["scheduled_delivery_timestamp"] <= time.time():
+            del app.scheduled[scheduled_message_id]
+            message["id"] = len(app.messages) + 1
+            app.messages.append(message)
+    return app.messages
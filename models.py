@@ -1,9 +1,11 @@
+import os
 from typing import Optional, Any
 
 import sqlalchemy
 from pydantic.main import BaseModel
 from pydantic.networks import EmailStr
 
+DEFAULT_REALM = "default"
 metadata = sqlalchemy.MetaData()
 
 reminders = sqlalchemy.Table(
@@ -20,7 +22,9 @@ reminders = sqlalchemy.Table(
     sqlalchemy.Column("active", sqlalchemy.Integer, default=1),
     sqlalchemy.Column("topic", sqlalchemy.String, nullable=True),
     sqlalchemy.Column("to", sqlalchemy.Integer),
-    sqlalchemy.Column("text_date", sqlalchemy.String)
+    sqlalchemy.Column("text_date", sqlalchemy.String),
+    sqlalchemy.Column("realm", sqlalchemy.String, default=DEFAULT_REALM, server_default=DEFAULT_REALM, index=True),
+    sqlalchemy.Column("scheduled_message_id", sqlalchemy.Integer, nullable=True)
 )
 
 intervals = sqlalchemy.Table(
@@ -28,7 +32,8 @@ intervals = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True, autoincrement=True),
     sqlalchemy.Column("reminder_id", sqlalchemy.Integer),
-    sqlalchemy.Column("interval_time", sqlalchemy.JSON)
+    sqlalchemy.Column("interval_time", sqlalchemy.JSON),
+    sqlalchemy.Column("realm", sqlalchemy.String, default=DEFAULT_REALM, server_default=DEFAULT_REALM)
 )
 
 timezone = sqlalchemy.Table(
@@ -36,17 +41,21 @@ timezone = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True, autoincrement=True),
     sqlalchemy.Column("zone", sqlalchemy.String),
-    sqlalchemy.Column("email", sqlalchemy.String, unique=True)
+    sqlalchemy.Column("email", sqlalchemy.String),
+    sqlalchemy.Column("realm", sqlalchemy.String, default=DEFAULT_REALM, server_default=DEFAULT_REALM),
+    sqlalchemy.UniqueConstraint("realm", "email")
 )
 
 
 class Email(BaseModel):
     zulip_user_email: EmailStr
+    realm: str = DEFAULT_REALM
 
 
 class Remove(BaseModel):
     id: int
     email: EmailStr
+    realm: str = DEFAULT_REALM
 
 
 class Reminder(BaseModel):
@@ -62,10 +71,53 @@ class Reminder(BaseModel):
     is_stream: Optional[bool] = False
     is_interval: bool = False
     is_use_timezone: bool = True
+    realm: str = DEFAULT_REALM
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./test1.db")
+
+
+def read_only_url(url: str) -> str:
+    """The same SQLite file as a `file:` URI opened read only, connect with `uri=True`."""
+    path = os.path.abspath(sqlalchemy.engine.make_url(url).database)
+    return f"sqlite:///file:{path}%3Fmode=ro"
 
 
-DATABASE_URL = "sqlite:///./test1.db"
 engine = sqlalchemy.create_engine(
     DATABASE_URL, connect_args={"check_same_thread": False}
 )
 metadata.create_all(engine)
+
+
+ADDED_COLUMNS = [
+    (reminders, "realm", f"VARCHAR DEFAULT '{DEFAULT_REALM}'"),
+    (intervals, "realm", f"VARCHAR DEFAULT '{DEFAULT_REALM}'"),
+    (timezone, "realm", f"VARCHAR DEFAULT '{DEFAULT_REALM}'"),
+    (reminders, "scheduled_message_id", "INTEGER"),
+]
+
+
+def add_missing_columns():
+    """Databases created by older versions get the columns added since, e.g. `realm` filled with the default realm."""
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table, name, definition in ADDED_COLUMNS:
+            if name not in {column["name"] for column in inspector.get_columns(table.name)}:
+                connection.execute(sqlalchemy.text(f"ALTER TABLE {table.name} ADD COLUMN {name} {definition}"))
+        connection.execute(sqlalchemy.text("CREATE INDEX IF NOT EXISTS ix_reminders_realm ON reminders (realm)"))
+        if any(constraint["column_names"] == ["email"] for constraint in inspector.get_unique_constraints(timezone.name)):
+            rebuild_timezones(connection)
+
+
+def rebuild_timezones(connection):
+    """Older databases have `email` unique on its own, SQLite can't drop that constraint,
+    so the table is created again with emails unique per realm and the rows copied over."""
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {timezone.name} RENAME TO {timezone.name}_old"))
+    timezone.create(connection)
+    connection.execute(sqlalchemy.text(
+        f"INSERT INTO {timezone.name} (id, zone, email, realm) SELECT id, zone, email, realm FROM {timezone.name}_old"
+    ))
+    connection.execute(sqlalchemy.text(f"DROP TABLE {timezone.name}_old"))
+
+
+add_missing_columns()
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+PARSE_EXECUTOR = os.environ.get("PARSE_EXECUTOR", "process")
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 2))
+PARSE_QUEUE = int(os.environ.get("PARSE_QUEUE", 32))
+PARSE_TIMEOUT = float(os.environ.get("PARSE_TIMEOUT", 10))
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class BoundedPool:
+    """Runs CPU heavy functions outside the event loop.
+
+    At most `workers + queue` calls are pending, further calls raise PoolBusy at once.
+    A call waiting longer than `timeout` seconds raises asyncio.TimeoutError, the worker
+    itself can't be interrupted and finishes it in the background. It stays pending until
+    the worker is done with it, so timed out calls still count against the limit.
+    When a worker dies the pool is broken: the call raises PoolBusy and the next one starts a new pool.
+    """
+
+    def __init__(self, kind: str = PARSE_EXECUTOR, workers: int = PARSE_WORKERS,
+                 queue: int = PARSE_QUEUE, timeout: float = PARSE_TIMEOUT):
+        self.kind = kind
+        self.workers = workers
+        self.limit = workers + queue
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="parse")
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.pending >= self.limit:
+            raise PoolBusy()
+        loop = asyncio.get_event_loop()
+        executor = self.executor
+        try:
+            future = executor.submit(func, *args)
+            self.pending += 1
+            future.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(self.done))
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), self.timeout)
+        except BrokenExecutor as e:
+            self.discard(executor, e)
+            raise PoolBusy() from e
+
+    def done(self):
+        self.pending -= 1
+
+    def discard(self, executor: Executor, error: Exception):
+        if self._executor is executor:
+            logger.error(f"Parse pool broken, starting a new one: {error}")
+            executor.shutdown(wait=False)
+            self._executor = None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+parse_pool = BoundedPool()
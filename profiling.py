@@ -0,0 +1,171 @@
+"""Where the time goes: on-demand sampling profiler and the last slow requests and job runs."""
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from typing import AsyncIterator, Deque, Optional
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+SLOW_CAPTURE = os.environ.get("SLOW_CAPTURE", "0") == "1"
+SLOW_THRESHOLD = float(os.environ.get("SLOW_THRESHOLD", 1))
+SLOW_KEEP = int(os.environ.get("SLOW_KEEP", 50))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def is_admin(headers) -> bool:
+    return ADMIN_TOKEN is not None and headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+
+class Trace:
+    __slots__ = ("kind", "name", "at", "started", "phases", "open")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.at = time.time()
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.open = False
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Adds the time spent inside to phase `name` of the request or job being traced, if any."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(trace, name, time.perf_counter() - started)
+
+
+def add_time(trace: Optional[Trace], name: str, seconds: float):
+    """Adds `seconds` to phase `name` of `trace`, for work done outside the traced task."""
+    if trace is not None:
+        trace.phases[name] = trace.phases.get(name, 0.0) + seconds
+
+
+class SlowLog:
+    """Last `keep` requests and job runs that took at least `threshold` seconds, with time per phase.
+
+    Time outside of the traced phases is reported as `other`.
+    """
+
+    def __init__(self, enabled: bool = SLOW_CAPTURE, threshold: float = SLOW_THRESHOLD, keep: int = SLOW_KEEP):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.entries: Deque[dict] = collections.deque(maxlen=keep)
+
+    def settings(self) -> dict:
+        return {"enabled": self.enabled, "threshold": self.threshold, "keep": self.entries.maxlen}
+
+    def configure(self, enabled: Optional[bool] = None, threshold: Optional[float] = None, keep: Optional[int] = None):
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if threshold is not None:
+            self.threshold = float(threshold)
+        if keep is not None and int(keep) != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen=int(keep))
+
+    @contextlib.contextmanager
+    def trace(self, kind: str, name: str):
+        """Traces the block, the Trace is yielded or None when capture is off.
+        A Trace set `open` inside the block is finished later by `finish_after`."""
+        if not self.enabled:
+            yield None
+            return
+        trace = Trace(kind, name)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            if not trace.open:
+                self.finish(trace)
+
+    async def finish_after(self, trace: Trace, body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Passes a streamed response body through and finishes `trace` once it is sent."""
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            self.finish(trace)
+
+    def finish(self, trace: Trace):
+        total = time.perf_counter() - trace.started
+        if total < self.threshold:
+            return
+        phases = {name: round(seconds, 4) for name, seconds in trace.phases.items()}
+        phases["other"] = round(max(0.0, total - sum(trace.phases.values())), 4)
+        self.entries.append({
+            "kind": trace.kind, "name": trace.name, "at": trace.at, "total": round(total, 4), "phases": phases,
+        })
+
+    def traced(self, func):
+        """Traces every run of a coroutine job as `name(first argument)`."""
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with self.trace("job", f"{func.__name__}({args[0] if args else ''})"):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds from a background thread.
+
+    The result is in collapsed format, one `thread;outer frame;...;inner frame count` line per stack,
+    ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.running = False
+
+    def sample(self, seconds: float) -> collections.Counter:
+        stacks = collections.Counter()
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    async def profile(self, seconds: float) -> Optional[str]:
+        """Collapsed stacks of the next `seconds`, None when a profile is already running."""
+        if self.running:
+            return None
+        self.running = True
+        try:
+            stacks = await asyncio.get_event_loop().run_in_executor(
+                None, self.sample, min(seconds, PROFILE_MAX_SECONDS)
+            )
+        finally:
+            self.running = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+slow_log = SlowLog()
+profiler = SamplingProfiler()
@@ -0,0 +1,90 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import zulip
+
+from models import DEFAULT_REALM
+from profiling import phase
+
+logger = logging.getLogger()
+
+ZULIPRC = os.path.abspath(os.path.join(os.path.dirname(__file__), 'zuliprc'))
+REALM_CLIENTS = int(os.environ.get("REALM_CLIENTS", 2))
+REALM_CACHE_TTL = int(os.environ.get("REALM_CACHE_TTL", 300))
+
+
+class Realm:
+    """Zulip organization served by the bot: a pool of clients and caches of members and streams."""
+
+    def __init__(self, name: str, config_file: str, pool_size: int = REALM_CLIENTS):
+        self.name = name
+        self.clients = [zulip.Client(config_file=config_file) for _ in range(pool_size)]
+        self._clients = itertools.cycle(self.clients)
+        self._lock = threading.Lock()
+        self._members = []
+        self._members_time = 0.0
+        self._streams = {}
+
+    @property
+    def client(self) -> zulip.Client:
+        with self._lock:
+            return next(self._clients)
+
+    def send_message(self, message: dict) -> dict:
+        return self.client.send_message(message)
+
+    def get_members(self) -> list:
+        if time.monotonic() - self._members_time > REALM_CACHE_TTL:
+            with phase("zulip"):
+                self._members = self.client.get_members()['members']
+            self._members_time = time.monotonic()
+        return self._members
+
+    def get_user_id(self, email: str) -> Optional[int]:
+        for user in self.get_members():
+            if user["email"] == email:
+                return user["user_id"]
+
+    def schedule_message(self, message: dict, timestamp: float) -> Optional[int]:
+        """Hands the message to the server's scheduled messages, returns its id or None if the server refused."""
+        request = dict(message, scheduled_delivery_timestamp=int(timestamp))
+        with phase("zulip"):
+            response = self.client.call_endpoint(url="scheduled_messages", method="POST", request=request)
+        if response.get("result") != "success":
+            logger.warning(f"Scheduled message refused by {self.name}: {response}")
+            return None
+        return response["scheduled_message_id"]
+
+    def delete_scheduled_message(self, scheduled_message_id: int) -> bool:
+        with phase("zulip"):
+            response = self.client.call_endpoint(url=f"scheduled_messages/{scheduled_message_id}", method="DELETE")
+        return response.get("result") == "success"
+
+    def get_stream_id(self, stream: str) -> dict:
+        cached = self._streams.get(stream)
+        if cached is not None and time.monotonic() - cached[0] <= REALM_CACHE_TTL:
+            return cached[1]
+        with phase("zulip"):
+            response = self.client.get_stream_id(stream)
+        if response.get("result") == "success":
+            self._streams[stream] = (time.monotonic(), response)
+        return response
+
+
+def parse_realms(value: str) -> Dict[str, str]:
+    """`ZULIP_REALMS=first=/path/first.zuliprc,second=/path/second.zuliprc`"""
+    config = {}
+    for item in filter(None, value.split(",")):
+        name, config_file = item.split("=", 1)
+        config[name.strip()] = os.path.abspath(config_file.strip())
+    return config or {DEFAULT_REALM: ZULIPRC}
+
+
+def load_realms() -> Dict[str, Realm]:
+    config = parse_realms(os.environ.get("ZULIP_REALMS", ""))
+    logger.info(f"Realms: {', '.join(config)}")
+    return {name: Realm(name, config_file) for name, config_file in config.items()}
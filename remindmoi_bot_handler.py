@@ -2,6 +2,7 @@ import json
 import logging
 from typing import Any, Dict
 
+import orjson
 import requests
 import urllib3
 
@@ -10,7 +11,8 @@ from bot_helpers import (REMOVE_ENDPOINT,
                          parse_remove_command_content,
                          generate_reminders_list,
                          is_set_timezone,
-                         set_timezone, SET_TIMEZONE, parse_cmd, get_path, WHO_ENDPOINT, generate_who_list)
+                         set_timezone, SET_TIMEZONE, parse_cmd, get_path, WHO_ENDPOINT, generate_who_list,
+                         REALM, ServerBusy, raise_if_busy, busy_message, INTERNAL_TOKEN)
 
 USAGE = '''
 The first step is to set timezone:
@@ -20,6 +22,7 @@ For example:
 
 To find out who the creator of a reminder in a stream is, write `who #stream_name` to the bot:
 ``who #general``
+or write ``@reminder who`` inside the stream
 It works only for stream reminders, personally reminders are protected
 
 To store a reminder, write a private message to chat with the bot 
@@ -81,6 +84,11 @@ urllib3.disable_warnings()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+api = requests.Session()
+api.hooks["response"].append(raise_if_busy)
+if INTERNAL_TOKEN:
+    api.headers["X-Internal-Token"] = INTERNAL_TOKEN
+
 
 class RemindMoiHandler:
 
@@ -101,19 +109,21 @@ def get_bot_response(message: Dict[str, Any], bot_handler: Any):
 
         if is_set_timezone(content):
             request = set_timezone(content, message["sender_email"])
-            response = requests.post(url=SET_TIMEZONE, json=request)
+            request["realm"] = REALM
+            response = api.post(url=SET_TIMEZONE, json=request)
             response = response.json()
             assert response["success"]
             return "Thanks"
 
         if content.startswith("remove"):
             reminder_id = parse_remove_command_content(content, message["sender_email"])
-            response = requests.post(url=REMOVE_ENDPOINT, json=reminder_id)
+            reminder_id["realm"] = REALM
+            response = api.post(url=REMOVE_ENDPOINT, json=reminder_id)
             response = response.json()
             return "Reminder deleted." if response['success'] else "It is not your reminder"
         if content.startswith("list"):
-            zulip_user_email = {"zulip_user_email": message["sender_email"]}
-            response = requests.post(url=LIST_ENDPOINT, json=zulip_user_email)
+            zulip_user_email = {"zulip_user_email": message["sender_email"], "realm": REALM}
+            response = api.post(url=LIST_ENDPOINT, json=zulip_user_email)
             response = response.json()
 
             assert response["success"]
@@ -121,7 +131,10 @@ def get_bot_response(message: Dict[str, Any], bot_handler: Any):
 
         if content.startswith("who"):
             stream_name = " ".join(content.split()[1::])
-            response = requests.get(url=WHO_ENDPOINT, params=dict(stream_name=stream_name))
+            params = dict(stream_name=stream_name, realm=REALM)
+            if not stream_name and message["type"] == "stream":
+                params = dict(stream_id=message["stream_id"], realm=REALM)
+            response = api.get(url=WHO_ENDPOINT, params=params)
             response = response.json()
             if response["success"]:
                 reminders = response["reminders"]
@@ -148,8 +161,9 @@ def get_bot_response(message: Dict[str, Any], bot_handler: Any):
             "full_content": content,
             "text_date": text_date,
             "is_use_timezone": is_use_timezone,
+            "realm": REALM,
         }
-        response = requests.post(url=url, json=reminder,
+        response = api.post(url=url, data=orjson.dumps(reminder),
                                  headers={"Content-Type": "application/json; charset=utf-8"}).json()
 
         response_to = "you" if raw_to == "me" else raw_to
@@ -158,6 +172,9 @@ def get_bot_response(message: Dict[str, Any], bot_handler: Any):
         return_message = f'I will remind {response_to} {prefix} "{text}" {text_date}. Reminder id {response["result"]}'
         return return_message
 
+    except ServerBusy as e:
+        logger.warning(f"Server busy, retry after {e.retry_after}s")
+        return busy_message(e)
     except requests.exceptions.ConnectionError:
         logger.warning("Server not running")
         return "Server not running, call Pavlo Y."
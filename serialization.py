@@ -0,0 +1,159 @@
+"""orjson responses streamed from the DB cursor and cheap validation for the bot.
+
+`python serialization.py` compares both against the pydantic/`jsonable_encoder` path for large lists.
+"""
+import os
+from typing import AsyncIterator, Optional
+
+import orjson
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from starlette.responses import StreamingResponse
+
+from models import Reminder
+from profiling import phase
+
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 500))
+INTERNAL_TOKEN = os.environ.get("INTERNAL_TOKEN")
+REQUIRED_FIELDS = [name for name, field in Reminder.__fields__.items() if field.required]
+
+
+async def iterate_json_rows(database, query: str, values: dict, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Rows of a raw SQL query as comma separated JSON objects, `chunk_size` rows per chunk.
+
+    Reads the aiosqlite cursor directly, so no Record is built per row.
+    """
+    async with database.connection() as connection:
+        with phase("db"):
+            cursor = await connection.raw_connection.execute(query, values)
+        try:
+            names = [column[0] for column in cursor.description]
+            while True:
+                with phase("db"):
+                    rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield orjson.dumps([dict(zip(names, row)) for row in rows])[1:-1]
+        finally:
+            await cursor.close()
+
+
+async def json_list_body(head: dict, key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    yield orjson.dumps(head)[:-1] + b',"' + key.encode() + b'":['
+    separator = b""
+    async for chunk in chunks:
+        yield separator + chunk
+        separator = b","
+    yield b"]}"
+
+
+def stream_rows(database, query: str, values: dict, key: str, head: Optional[dict] = None) -> StreamingResponse:
+    """`{**head, key: [rows]}` written while the rows are read."""
+    head = {"success": True} if head is None else head
+    return StreamingResponse(
+        json_list_body(head, key, iterate_json_rows(database, query, values)), media_type="application/json"
+    )
+
+
+def trusted_reminder(data: dict) -> Reminder:
+    """Reminder from the bot: required fields are checked and `created` is made a float,
+    everything else, the email check included, is taken as sent."""
+    missing = [name for name in REQUIRED_FIELDS if name not in data]
+    if missing:
+        raise ValueError(f"Missing {missing}")
+    data["created"] = float(data["created"])
+    return Reminder.construct(**{name: data[name] for name in Reminder.__fields__ if name in data})
+
+
+def is_trusted(request: Request) -> bool:
+    return INTERNAL_TOKEN is not None and request.headers.get("X-Internal-Token") == INTERNAL_TOKEN
+
+
+async def reminder_body(request: Request) -> Reminder:
+    """Request body as Reminder, fully validated unless it comes from the bot with INTERNAL_TOKEN."""
+    body = await request.body()
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError([ErrorWrapper(e, ("body", e.pos))], body=body)
+    if is_trusted(request) and isinstance(data, dict):
+        try:
+            return trusted_reminder(data)
+        except (TypeError, ValueError):
+            pass
+    try:
+        return Reminder.parse_obj(data)
+    except ValidationError as e:
+        raise RequestValidationError([ErrorWrapper(e, ("body",))], body=data)
+
+
+def benchmark(count: int = 50000, rounds: int = 5):
+    import asyncio
+    import tempfile
+    import time
+
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp(prefix='remindmoi-serialization-')}/bench.db"
+    import realms
+    realms.load_realms = lambda: {}
+    import app
+    from fastapi.encoders import jsonable_encoder
+    from starlette.responses import JSONResponse
+    from models import engine, metadata, reminders
+
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(reminders.insert(), [dict(
+            zulip_user_email="user@example.com", text=f"standup {i}", created=time.time(), is_interval=True,
+            is_stream=True, active=1, full_content=f"#**general** standup {i} every weekday at 10:00", to=1,
+            text_date="every weekday at 10:00", realm="default",
+        ) for i in range(count)])
+
+    async def render(response) -> bytes:
+        if isinstance(response, StreamingResponse):
+            return b"".join([chunk async for chunk in response.body_iterator])
+        return JSONResponse(jsonable_encoder(response)).body
+
+    async def run(name: str, endpoint, *args) -> bytes:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            body = await render(await endpoint(*args))
+        print(f"{name}: {(time.perf_counter() - started) / rounds * 1000:.0f} ms, {len(body) / 2 ** 20:.1f} MB")
+        return body
+
+    async def main():
+        await app.database.connect()
+        email = app.Email(zulip_user_email="user@example.com")
+        print(f"/list_reminders with {count} reminders")
+        current = await run("  fetch_all, dicts, jsonable_encoder", list_reminders_current, email)
+        fast = await run("  orjson streamed from the cursor", app.list_reminders, email)
+        print(f"  same content: {orjson.loads(current) == orjson.loads(fast)}")
+        await app.database.disconnect()
+
+    async def list_reminders_current(request):
+        user_reminders = await app.database.fetch_all(reminders.select().where(
+            reminders.c.zulip_user_email == request.zulip_user_email
+        ))
+        return {"success": True, "reminders_list": [{
+            "id": reminder.id, "content": reminder.full_content, "active": reminder.active,
+            "text_date": reminder.text_date,
+        } for reminder in user_reminders]}
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+    data = {"zulip_user_email": "user@example.com", "text": "standup", "created": "1640995200.0",
+            "full_content": "#**general** standup every weekday at 10:00", "text_date": "every weekday at 10:00",
+            "to": 1, "time": ["weekday", "at", "10:00"], "is_stream": True, "topic": "reminder",
+            "is_interval": True, "is_use_timezone": True, "realm": "default"}
+    body = orjson.dumps(data)
+    for name, validate in (("pydantic Reminder", lambda: Reminder.parse_raw(body)),
+                           ("trusted_reminder", lambda: trusted_reminder(orjson.loads(body)))):
+        started = time.perf_counter()
+        for _ in range(count):
+            validate()
+        print(f"{name}: {(time.perf_counter() - started) / count * 10 ** 6:.1f} us per reminder body")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,345 @@
+"""Capacity planning against a virtual clock.
+
+`python simulate.py --standups 50000 --at 09:00 --days 2 --latency 0.05 --rate 3`
+
+Runs the real scheduler, job functions, outbox and DB layer of app.py in an event loop whose
+clock jumps to the next timer as soon as nothing is running, with a stand-in zulip server that
+has latency and a rate limit in virtual time. Prints fire lateness, throughput, peak queue depths and
+memory for every simulated interval. The database lives in a temporary directory.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import resource
+import selectors
+import sys
+import tempfile
+import threading
+import time
+import types
+
+REAL_WAIT = 0.002
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+
+class VirtualSelector(selectors.BaseSelector):
+    """Waits for real I/O only briefly, then moves the loop's clock to the next timer instead of sleeping."""
+
+    def __init__(self, loop: "VirtualClockLoop"):
+        self.loop = loop
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self.selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.selector.modify(fileobj, events, data)
+
+    def get_key(self, fileobj):
+        return self.selector.get_key(fileobj)
+
+    def get_map(self):
+        return self.selector.get_map()
+
+    def close(self):
+        self.selector.close()
+
+    def select(self, timeout=None):
+        events = self.selector.select(0)
+        if events or timeout == 0:
+            return events
+        events = self.selector.select(REAL_WAIT)
+        if events or self.loop.in_flight or timeout is None:
+            return events
+        self.loop.advance(timeout)
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time() is virtual, it stands still while executor threads are working."""
+
+    def __init__(self):
+        self.virtual = 0.0
+        self.in_flight = 0
+        super().__init__(VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.virtual
+
+    def advance(self, seconds: float):
+        self.virtual += seconds
+
+    def run_in_executor(self, executor, func, *args):
+        self.in_flight += 1
+        future = super().run_in_executor(executor, func, *args)
+        future.add_done_callback(self._executor_done)
+        return future
+
+    def _executor_done(self, _):
+        self.in_flight -= 1
+
+    def thread_sleep(self, seconds: float):
+        """Sleep of an executor thread in virtual time, the clock may move meanwhile."""
+        done = threading.Event()
+
+        def wake():
+            self.in_flight += 1
+            done.set()
+
+        def start():
+            self.in_flight -= 1
+            self.call_later(seconds, wake)
+
+        self.call_soon_threadsafe(start)
+        done.wait()
+
+
+loop = VirtualClockLoop()
+asyncio.set_event_loop(loop)
+
+
+class VirtualDatetime(datetime.datetime):
+    start = datetime.datetime.now(datetime.timezone.utc)
+
+    @classmethod
+    def now(cls, tz=None):
+        moment = cls.start + datetime.timedelta(seconds=loop.time())
+        return moment.astimezone(tz) if tz else moment.replace(tzinfo=None)
+
+
+class SimulatedRealm:
+    """Stand-in zulip server: every message takes `latency` seconds, over `rate` messages per second
+    it answers with a rate limit and the sender waits like the zulip client does."""
+
+    def __init__(self, name: str, latency: float, rate: float):
+        self.name = name
+        self.latency = latency
+        self.rate = rate
+        self.tokens = rate
+        self.updated = 0.0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        with self.lock:
+            now = loop.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            self.rate_limited += 1
+            return (1 - self.tokens) / self.rate
+
+    def send_message(self, message: dict) -> dict:
+        wait = self.retry_after()
+        while wait:
+            loop.thread_sleep(wait)
+            wait = self.retry_after()
+        loop.thread_sleep(self.latency)
+        return {"result": "success", "msg": ""}
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def parse_args():
+    args = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    args.add_argument("--standups", type=int, default=1000, help="weekday reminders at --at")
+    args.add_argument("--at", default="09:00")
+    args.add_argument("--one-time", type=int, default=0, help="one-time reminders spread over the run")
+    args.add_argument("--to-stream", type=float, default=0.5,
+                      help="share of one-time reminders sent to a stream with send_reminder_to")
+    args.add_argument("--days", type=float, default=1)
+    args.add_argument("--start", default=None, help="virtual start, default next Monday 08:00 UTC")
+    args.add_argument("--latency", type=float, default=0.05, help="zulip API latency, seconds")
+    args.add_argument("--rate", type=float, default=3, help="zulip API messages per second")
+    args.add_argument("--outbox-rate", type=float, default=None, help="OUTBOX_RATE, default --rate")
+    args.add_argument("--sample", type=float, default=300, help="report interval, simulated seconds")
+    args.add_argument("--health-interval", type=float, default=60,
+                      help="HEALTH_INTERVAL, simulated seconds, every tick costs real time")
+    return args.parse_args()
+
+
+def configure(options):
+    if options.start:
+        start = datetime.datetime.fromisoformat(options.start)
+    else:
+        today = datetime.datetime.utcnow().replace(hour=8, minute=0, second=0, microsecond=0)
+        start = today + datetime.timedelta(days=(7 - today.weekday()) % 7 or 7)
+    VirtualDatetime.start = start.replace(tzinfo=datetime.timezone.utc)
+
+    workdir = tempfile.mkdtemp(prefix="remindmoi-simulation-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'simulation.db')}"
+    os.environ["OUTBOX_RATE"] = str(options.outbox_rate or options.rate)
+    os.environ["HEALTH_INTERVAL"] = str(options.health_interval)
+
+    import apscheduler.executors.base
+    import apscheduler.executors.base_py3
+    import apscheduler.schedulers.base
+    import apscheduler.triggers.date
+    import apscheduler.triggers.interval
+    for module in (apscheduler.executors.base, apscheduler.executors.base_py3, apscheduler.schedulers.base,
+                   apscheduler.triggers.date, apscheduler.triggers.interval):
+        module.datetime = VirtualDatetime
+    return workdir
+
+
+async def populate(app, options):
+    from models import reminders
+    app.schedule.pause()
+    hour, minute = map(int, options.at.split(":"))
+    end = options.days * 86400
+    to_stream = round(options.one_time * options.to_stream)
+    kinds = ["standup"] * options.standups + ["to-stream"] * to_stream + ["one-time"] * (options.one_time - to_stream)
+
+    def recipient(i: int, kind: str) -> types.SimpleNamespace:
+        is_stream = kind == "to-stream"
+        return types.SimpleNamespace(
+            zulip_user_email=f"user{i % 1000}@example.com", text=f"{kind} {i}", to=i % (100 if is_stream else 1000) + 1,
+            is_stream=is_stream, is_interval=kind == "standup", topic="reminder" if is_stream else None,
+            realm="default", text_date="simulation",
+        )
+
+    for chunk in range(0, len(kinds), 1000):
+        reminders_chunk = [recipient(i, kind) for i, kind in enumerate(kinds[chunk:chunk + 1000], start=chunk)]
+        ids = await asyncio.gather(*[
+            app.writer.execute(reminders.insert().values(
+                zulip_user_email=reminder.zulip_user_email, text=reminder.text, created=time.time(),
+                full_content=reminder.text, is_interval=reminder.is_interval, is_stream=reminder.is_stream, active=1,
+                to=reminder.to, topic=reminder.topic, text_date="simulation", realm="default",
+            ))
+            for reminder in reminders_chunk
+        ])
+        for reminder_id, kind, reminder in zip(ids, kinds[chunk:chunk + 1000], reminders_chunk):
+            app.active_reminders.add(reminder_id, reminder)
+            run_date = VirtualDatetime.now() + datetime.timedelta(seconds=random.uniform(0, end))
+            if kind == "standup":
+                app.schedule.add_job(app.send_interval_reminder, "cron", day_of_week="mon-fri", hour=hour,
+                                     minute=minute, args=[reminder_id, reminder.to, False, None],
+                                     id=str(reminder_id))
+            elif kind == "to-stream":
+                app.schedule.add_job(app.send_reminder_to, "date", run_date=run_date, args=[reminder_id, reminder.to],
+                                     id=str(reminder_id))
+            else:
+                app.schedule.add_job(app.send_reminder_to_me, "date", run_date=run_date, args=[reminder_id],
+                                     id=str(reminder_id))
+    app.schedule.resume()
+
+
+class Peaks:
+    """Deepest outbox and writer queue, checked on every put instead of at sample times."""
+
+    def __init__(self, app):
+        self.outbox = self.writer = 0
+        self.total_outbox = self.total_writer = 0
+        outbox_put, writer_execute = app.outbox.put, app.writer.execute
+
+        def put(*args, **kwargs):
+            outbox_put(*args, **kwargs)
+            self.outbox = max(self.outbox, app.outbox.depth())
+
+        def execute(*args, **kwargs):
+            self.writer = max(self.writer, app.writer.queue.qsize() + 1)
+            return writer_execute(*args, **kwargs)
+
+        app.outbox.put, app.writer.execute = put, execute
+
+    def sample(self) -> tuple:
+        """Peaks since the last sample."""
+        outbox, writer = self.outbox, self.writer
+        self.total_outbox, self.total_writer = max(self.total_outbox, outbox), max(self.total_writer, writer)
+        self.outbox = self.writer = 0
+        return outbox, writer
+
+
+async def simulate(app, options):
+    from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+    stats = {"submitted": 0, "done": 0, "missed": 0, "errors": 0, "lateness": []}
+
+    def listener(event):
+        if event.code == EVENT_JOB_SUBMITTED:
+            stats["submitted"] += 1
+            return
+        stats["done"] += 1
+        if event.code == EVENT_JOB_MISSED:
+            stats["missed"] += 1
+        elif event.code == EVENT_JOB_ERROR:
+            stats["errors"] += 1
+        else:
+            late = (VirtualDatetime.now(datetime.timezone.utc) - event.scheduled_run_time).total_seconds()
+            stats["lateness"].append(late)
+
+    app.schedule.add_listener(listener, EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+    all_lateness, peaks, depths = [], {"rss": 0.0}, Peaks(app)
+    print(f"{'simulated time':<17} {'sent':>7} {'p50 late':>9} {'p95 late':>9} {'max late':>9} "
+          f"{'missed':>7} {'outbox':>7} {'writer':>7} {'running':>8} {'rss MB':>7}")
+    end = options.days * 86400
+    while loop.time() < end:
+        await asyncio.sleep(min(options.sample, end - loop.time()))
+        lateness, stats["lateness"] = stats["lateness"], []
+        all_lateness.extend(lateness)
+        outbox, writer = depths.sample()
+        rss = rss_mb()
+        peaks["rss"] = max(peaks["rss"], rss)
+        print(f"{VirtualDatetime.now():%a %m-%d %H:%M:%S} {len(lateness):>7} {percentile(lateness, 0.5):>8.1f}s "
+              f"{percentile(lateness, 0.95):>8.1f}s {max(lateness, default=0):>8.1f}s {stats['missed']:>7} "
+              f"{outbox:>7} {writer:>7} {stats['submitted'] - stats['done']:>8} {rss:>7.1f}")
+    peaks["outbox"], peaks["writer"] = depths.total_outbox, depths.total_writer
+    return all_lateness, stats, peaks
+
+
+def main():
+    options = parse_args()
+    workdir = configure(options)
+    started = time.perf_counter()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import realms
+    from models import DEFAULT_REALM
+    realm = SimulatedRealm(DEFAULT_REALM, options.latency, options.rate)
+    realms.load_realms = lambda: {DEFAULT_REALM: realm}
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    async def run():
+        await app.startup()
+        await populate(app, options)
+        print(f"{options.standups} standups and {options.one_time} one-time reminders "
+              f"({round(options.one_time * options.to_stream)} to streams) scheduled "
+              f"in {time.perf_counter() - started:.1f}s, database in {workdir}")
+        simulated = time.perf_counter()
+        result = await simulate(app, options)
+        await app.shutdown()
+        return result, time.perf_counter() - simulated
+
+    (lateness, stats, peaks), wall = loop.run_until_complete(run())
+    print(f"\n{len(lateness)} sent, {stats['missed']} missed, {stats['errors']} failed, "
+          f"{realm.rate_limited} rate limited responses")
+    print(f"lateness p50 {percentile(lateness, 0.5):.1f}s, p95 {percentile(lateness, 0.95):.1f}s, "
+          f"max {max(lateness, default=0):.1f}s")
+    print(f"peak outbox {peaks['outbox']}, peak writer queue {peaks['writer']}, peak rss {peaks['rss']:.1f} MB")
+    print(f"{options.days * 24:.0f} simulated hours in {wall:.0f}s of wall time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import datetime
+import logging
+import re
+from math import modf
+
+from dateparser.search import search_dates
+from dateutil import parser
+
+logger = logging.getLogger()
+
+ARGS_WEEK_DAY = {
+    "monday", "tuesday", "wednesday", "thursday", "friday",
+    "saturday", "sunday"
+}
+DAY_DICT = {"monday": "mon", "tuesday": "tue", "wednesday": "wed", "thursday": "thu", "friday": "fri",
+            "saturday": "sat", "sunday": "sun"}
+ARGS_INTERVAL = {"minute", "hour", "day", "week", "month", "minutes", "hours", "days", "weeks", "months"}
+FREQUENCY = {"second": 2, "2nd": 2, "2": 2, "3": 3, "two": 2, "three": 3, "3rd": 3, "third": 3, "4": 4, "4th": 4, "four": 4}
+
+
+def convert_zone(zone: float):
+    minutes, hour = modf(zone)
+    minutes *= 60
+    return int(hour), int(minutes)
+
+
+def get_task(time, zone: float) -> tuple:
+    """Scheduler trigger and its arguments for a recurring reminder, runs in the parse pool."""
+    task = {}
+    trigger = "cron"
+    if isinstance(time, list):
+        task, trigger = get_time_from_list(time, task, zone)
+    if isinstance(time, str):
+        hour, minutes = convert_zone(zone)
+        time = parser.parse(time) + datetime.timedelta(hours=hour, minutes=minutes)
+        task["day_of_week"] = time.weekday()
+        task["hour"] = time.hour
+        task["minute"] = time.minute
+    return task, trigger
+
+
+def get_time_from_list(time: list, task: dict, zone):
+    if is_last_or_first_day_moth(time):
+        time[0] = time[0] if time[0] == "last" else 1
+        if all(i in time for i in ("day", "month")):
+            hours, minutes = convert_zone(zone)
+            task = {"year": "*", "month": "*", "day": time[0], "hour": 9 + hours, "minute": 0 + minutes}
+            if re.search(r"at \d{2}:\d{2}", " ".join(time)):
+                idx = time.index("at") + 1
+                hour, minute = time[idx].split(":")
+                task["hour"] = int(hour) + hours
+                task["minute"] = int(minute) + minutes
+            return task, "cron"
+    if any(i in ARGS_INTERVAL for i in time):
+        return get_interval_time(time, task, zone)
+
+    if sum(1 for i in time if i.lower().replace(",", "") in ARGS_WEEK_DAY) > 1:
+        return get_multiple_day_time(time, task, zone)
+    if "weekday" in time:
+        days = ["monday", "tuesday", "wednesday", "thursday", "friday"]
+        idx = time.index("weekday")
+        time[idx:idx] = days
+        time.remove("weekday")
+        return get_multiple_day_time(time, task, zone)
+    logger.warning(f"Time from list, unsupported type: {time}")
+
+
+def is_last_or_first_day_moth(time):
+    return time[0] in {"last", "first", "1st"}
+
+
+def get_multiple_day_time(time: list, task: dict, zone: float):
+    hour, minute = convert_zone(zone)
+    days = []
+    time_idx = None
+    for idx, i in enumerate(time):
+        i = i.replace(",", "").lower()
+        if i == "at":
+            time_idx = idx
+        if DAY_DICT.get(i) is not None:
+            days.append(DAY_DICT[i])
+    time = time[time_idx + 1]
+    date = datetime.datetime.strptime(time, "%H:%M")
+    date = date + datetime.timedelta(hours=hour, minutes=minute)
+    task["day_of_week"] = ",".join(days)
+    task["hour"] = date.hour
+    task["minute"] = date.minute
+    trigger = "cron"
+    return task, trigger
+
+
+def get_interval_time(time: list, task: dict, zone):
+    try:
+        frequency = int(time[0])
+    except ValueError:
+        frequency = FREQUENCY.get(time[0], 1)
+
+    idx = 0 if frequency == 1 else 1
+    if time[idx] in ARGS_INTERVAL:
+        interval = time[idx] if time[idx].endswith('s') else time[idx] + "s"
+        task[interval] = frequency
+    if "at" not in time:
+        time.insert(idx + 1, "at 9:00")
+    time = time[idx + 1::]
+    time, start = find_start_end(time, "start")
+    start, end = find_start_end(start, "end")
+    tuple_date = search_dates(" ".join(time), settings={"PREFER_DATES_FROM": "current_period"})
+    hour, minute = convert_zone(zone)
+    date: datetime = tuple_date[0][1] + datetime.timedelta(hours=hour, minutes=minute)
+    hours = date.hour
+    minutes = date.minute
+    if start:
+        start_date = search_dates(" ".join(start))[-1][-1]
+
+        start_date = start_date.replace(hour=hours, minute=minutes, second=0)
+        task["start_date"] = start_date
+    else:
+        date = date if date > datetime.datetime.now() else date + datetime.timedelta(**task)
+        task["start_date"] = date
+    if end:
+        end_date = search_dates(" ".join(end))[-1][-1]
+        end_date = end_date.replace(hour=hours, minute=minutes, second=0)
+        task["end_date"] = end_date
+
+    trigger = "interval"
+    if task.get("months") is not None:
+        trigger = "cron"
+        value = task["months"]
+        del task["months"]
+        interval_value = "*" if value == 1 else f"*/{value}"
+        task["month"] = interval_value
+
+    return task, trigger
+
+
+def find_start_end(time: list, value: str):
+    try:
+        idx = time.index(value)
+        return time[:idx], time[idx + 1:]
+    except ValueError:
+        return time, []
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy.pool import StaticPool
+
+from profiling import phase
+
+logger = logging.getLogger()
+
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 100))
+WRITE_BATCH_DELAY = float(os.environ.get("WRITE_BATCH_DELAY", 0.005))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", 30))
+
+
+class GroupWriter:
+    """The only writer of reminders, intervals and timezones, the API reads through read only connections.
+
+    Writes are queued and committed together in one transaction once `batch_size` are
+    waiting or `batch_delay` seconds passed since the first one. The whole group runs on one
+    connection in the writer thread. When a statement fails the group is rolled back and its
+    writes are committed one by one, so only that write fails.
+
+    APScheduler's jobstore still writes its jobs table in the same file on its own connection,
+    WAL and the WRITE_TIMEOUT busy timeout let it wait for a group instead of failing.
+    """
+
+    def __init__(self, url: str, batch_size: int = WRITE_BATCH_SIZE, batch_delay: float = WRITE_BATCH_DELAY):
+        self.engine = sqlalchemy.create_engine(
+            url, connect_args={"check_same_thread": False, "timeout": WRITE_TIMEOUT}, poolclass=StaticPool
+        )
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="writer")
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+        with self.engine.connect() as connection:
+            connection.execute(sqlalchemy.text("PRAGMA journal_mode=WAL"))
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            await self.queue.join()
+            self.task.cancel()
+            self.task = None
+        self.executor.shutdown()
+        self.engine.dispose()
+
+    async def execute(self, query, values: Optional[dict] = None):
+        """Returns lastrowid like `databases.Database.execute`."""
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((query, values, future))
+        with phase("db"):
+            return await future
+
+    def commit(self, batch: list) -> list:
+        with self.engine.begin() as connection:
+            return [
+                (connection.execute(sqlalchemy.text(query) if isinstance(query, str) else query, values or {}).lastrowid,
+                 None)
+                for query, values, _ in batch
+            ]
+
+    def commit_each(self, batch: list) -> list:
+        try:
+            return self.commit(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                return [(None, e)]
+            logger.warning(f"Group commit of {len(batch)} writes failed, commit one by one: {e}")
+        results = []
+        for item in batch:
+            try:
+                results.extend(self.commit([item]))
+            except Exception as e:
+                results.append((None, e))
+        return results
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self.executor, self.commit_each, batch)
+            except Exception as e:
+                results = [(None, e)] * len(batch)
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            for _ in batch:
+                self.queue.task_done()